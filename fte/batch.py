@@ -0,0 +1,82 @@
+import sys
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, zip_longest
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import settings
+
+# A story's url, its ebook's path (or None), error (or None), and seconds
+BATCH_RESULT = Tuple[str, Optional[str], Optional[str], float]
+
+
+def read_urls(source: str) -> List[str]:
+    """Read story urls, one per line, from a file or - (stdin)
+
+    Blank lines and lines starting with # are skipped, as are repeats.
+    """
+    if source == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, encoding="utf-8") as url_file:
+            lines = url_file.read().splitlines()
+
+    urls = [line.strip() for line in lines]
+    return list(dict.fromkeys(u for u in urls if u and not u.startswith("#")))
+
+
+def _interleave_hosts(urls: List[str]) -> List[str]:
+    """Alternate between sites, so no site's stories queue behind another's"""
+    by_host: Dict[str, List[str]] = {}
+    for url in urls:
+        by_host.setdefault(urlparse(url).netloc, []).append(url)
+
+    rounds = zip_longest(*by_host.values())
+    return [url for url in chain.from_iterable(rounds) if url is not None]
+
+
+def run_batch(
+    build: Callable[..., str],
+    urls: List[str],
+    stories: int = None,
+    **kwargs,
+) -> List[BATCH_RESULT]:
+    """Build every story's ebook in this one process. Return the results
+
+    Up to stories are built at once. They share the connections, caches,
+    and per site limits, so any number of stories stays polite to each
+    site. A failed story is recorded and the rest carry on. build is
+    called with a url and kwargs, and returns the ebook's path. Results
+    are in urls' order.
+    """
+    if stories is None:
+        stories = settings.batch_stories
+
+    def build_one(url: str) -> BATCH_RESULT:
+        start = monotonic()
+        try:
+            ebook = build(url, **kwargs)
+        except Exception as e:
+            return url, None, str(e), monotonic() - start
+        return url, ebook, None, monotonic() - start
+
+    if not urls:
+        return []
+
+    # Started in this order, so every site has a story going early on
+    order = _interleave_hosts(urls)
+    with ThreadPoolExecutor(max_workers=max(stories, 1)) as pool:
+        results = dict(zip(order, pool.map(build_one, order)))
+
+    return [results[url] for url in urls]
+
+
+def print_summary(results: List[BATCH_RESULT], seconds: float) -> None:
+    built = [result for result in results if result[2] is None]
+    print(f"\nBuilt {len(built)} of {len(results)} ebooks in {seconds:.1f}s")
+
+    for url, ebook, error, took in results:
+        status = "ok" if error is None else "FAILED"
+        print(f"  {status:<6} {took:7.1f}s  {url}")
+        print(f"           {ebook if error is None else error}")
@@ -0,0 +1,176 @@
+import json
+import os
+from hashlib import sha256
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+from typing import Optional, Tuple
+from urllib.parse import urlparse, urlunparse
+
+import requests
+
+import settings
+
+
+def canonical_url(url: str) -> str:
+    """The url's cache identity: lowercase scheme and host, no fragment"""
+    pieces = urlparse(url)
+    return urlunparse(
+        pieces._replace(
+            scheme=pieces.scheme.lower(),
+            netloc=pieces.netloc.lower(),
+            path=pieces.path or "/",
+            fragment="",
+        )
+    )
+
+
+def _last_used(meta_path: Path) -> float:
+    try:
+        return meta_path.stat().st_mtime
+    except OSError:  # already evicted by another process
+        return 0.0
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Write data so readers never see a half written file"""
+    with NamedTemporaryFile(dir=path.parent, delete=False) as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_file.name, path)
+
+
+class HTTPCache:
+    """Pages kept on disk between builds, keyed by their canonical url
+
+    Every entry is the raw body plus a small json file with the headers
+    needed to revalidate it (ETag, Last-Modified). Entries younger than
+    ttl seconds are used without asking the site. Once the cache outgrows
+    max_bytes, the oldest used entries are evicted until it is back under
+    EVICT_TO of it, so a full cache isn't rescanned on every store.
+    """
+
+    EVICT_TO = 0.9
+
+    def __init__(self, root: str, max_bytes: int, ttl: float = 0) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = Lock()
+        self._size = sum(
+            item.stat().st_size for item in self.root.glob("*/*.body")
+        )
+
+    def _paths(self, url: str) -> Tuple[Path, Path]:
+        key = sha256(canonical_url(url).encode("utf-8")).hexdigest()
+        return (
+            self.root / key[:2] / f"{key}.body",
+            self.root / key[:2] / f"{key}.json",
+        )
+
+    def lookup(self, url: str) -> Optional[dict]:
+        """Return the entry's metadata, if the url is cached"""
+        _, meta_path = self._paths(url)
+        try:
+            return json.loads(meta_path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, meta: dict) -> bool:
+        return time() - meta["stored_at"] < self.ttl
+
+    def validators(self, meta: dict) -> dict:
+        """Headers that ask the site whether the cached copy changed"""
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def load(self, url: str, meta: dict) -> Optional[requests.Response]:
+        """Rebuild the cached response. Marks it as recently used"""
+        body_path, meta_path = self._paths(url)
+        try:
+            body = body_path.read_bytes()
+            os.utime(meta_path)
+        except OSError:
+            return None
+
+        response = requests.Response()
+        response._content = body
+        response.status_code = 200
+        response.url = meta["url"]
+        response.encoding = meta.get("encoding")
+        response.headers.update(meta.get("headers", {}))
+        return response
+
+    def refresh(self, url: str, meta: dict) -> None:
+        """Restart a revalidated entry's ttl"""
+        _, meta_path = self._paths(url)
+        meta["stored_at"] = time()
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def store(self, url: str, response: requests.Response) -> None:
+        """Cache a successful response"""
+        body_path, meta_path = self._paths(url)
+        body_path.parent.mkdir(exist_ok=True)
+
+        meta = {
+            "url": response.url or url,
+            "stored_at": time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "encoding": response.encoding,
+            "headers": {
+                name: response.headers[name]
+                for name in ("Content-Type",)
+                if name in response.headers
+            },
+        }
+
+        with self._lock:
+            if body_path.is_file():
+                self._size -= body_path.stat().st_size
+            _write_atomic(body_path, response.content)
+            _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+            self._size += len(response.content)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache has room again"""
+        target = self.max_bytes * self.EVICT_TO
+        entries = sorted(self.root.glob("*/*.json"), key=_last_used)
+        for meta_path in entries:
+            if self._size <= target:
+                break
+            body_path = meta_path.with_suffix(".body")
+            try:
+                self._size -= body_path.stat().st_size
+                body_path.unlink()
+            except OSError:
+                pass
+            meta_path.unlink(missing_ok=True)
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_cache() -> Optional[HTTPCache]:
+    """Return the process wide cache, or None when caching is disabled"""
+    global _cache
+    with _cache_lock:
+        if not settings.cache_dir:
+            return None
+
+        if _cache is None or _cache.root != Path(settings.cache_dir):
+            _cache = HTTPCache(
+                settings.cache_dir,
+                settings.cache_max_bytes,
+                settings.cache_ttl,
+            )
+        return _cache
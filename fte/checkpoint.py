@@ -0,0 +1,61 @@
+import json
+import os
+from hashlib import sha256
+from pathlib import Path
+from shutil import rmtree
+from tempfile import NamedTemporaryFile
+
+import settings
+from utility import CHAPTER_DATA, KNOWN_CHAPTERS, fte_print
+
+
+class Checkpoint:
+    """A story's scraped chapters, saved to disk as soon as they arrive
+
+    Every story gets its own work directory (named after its url's hash)
+    holding one json file per chapter. A build that fails part way can
+    then be rerun and only scrape the chapters that weren't saved.
+    """
+
+    def __init__(self, root: str, story_url: str) -> None:
+        story_id = sha256(story_url.encode("utf-8")).hexdigest()
+        self.root = Path(root)
+        self.dir = self.root / story_id
+
+    def load(self) -> KNOWN_CHAPTERS:
+        """Return the chapters saved by earlier attempts, keyed by url"""
+        known = {}
+        if not self.dir.is_dir():
+            return known
+
+        for chapter_file in self.dir.glob("*.json"):
+            try:
+                saved = json.loads(chapter_file.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue  # unreadable checkpoints are just scraped again
+            known[saved["url"]] = (saved["name"], saved["content"])
+
+        fte_print(
+            f"Resuming with {len(known)} saved chapters", settings.verbosity
+        )
+        return known
+
+    def save(self, url: str, chapter: CHAPTER_DATA) -> None:
+        """Save one chapter. Safe to call from several threads at once"""
+        self.dir.mkdir(parents=True, exist_ok=True)
+        saved = {"url": url, "name": chapter[0], "content": str(chapter[1])}
+        chapter_id = sha256(url.encode("utf-8")).hexdigest()
+
+        with NamedTemporaryFile(
+            "w", encoding="utf-8", dir=self.dir, suffix=".tmp", delete=False
+        ) as tmp_file:
+            json.dump(saved, tmp_file)
+        os.replace(tmp_file.name, self.dir / f"{chapter_id}.json")
+
+    def clear(self) -> None:
+        """Delete the story's work directory once its ebook is written"""
+        rmtree(self.dir, ignore_errors=True)
+        try:
+            self.root.rmdir()  # only succeeds once no other story uses it
+        except OSError:
+            pass
@@ -1,31 +1,75 @@
+import os
 import re
+import json
+import warnings
+import zipfile
 from hashlib import sha256
-from shutil import move
+from pathlib import Path
+from os import PathLike
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+from typing import Union
 
+import metrics
 import settings
-from utility import CHAPTER, fte_print
+from images import ImageStore
+from utility import CHAPTER, CHAPTER_DATA, KNOWN_CHAPTERS, fte_print
+from utility import parse_html
 
+from bs4 import SoupStrainer, XMLParsedAsHTMLWarning
 from bs4.element import Tag
 from ebooklib import epub
 
+# Name of the OPF <meta> recording where each chapter came from
+MANIFEST_META = "fte-manifest"
 
-def create_epub(
-    title: str, author: str, summary: Tag, chapters: CHAPTER, cover: str
-) -> tuple[epub.EpubBook, str]:
-    """Following the ebooklib docs, assemble and write ebook"""
+
+def ebook_name(title: str, author: str, volume: int = None) -> str:
+    """The file name of the story's ebook, or of one of its volumes"""
+    volume_name = f" Volume {volume}" if volume is not None else ""
+    return re.sub("[ /]+", "-", f"{title} by {author}{volume_name}.epub")
+
+
+def volume_paths(dst_dir: str, title: str, author: str) -> List[str]:
+    """The paths of the story's volumes already in dst_dir, in order"""
+    paths = []
+    while True:
+        path = Path(dst_dir) / ebook_name(title, author, len(paths) + 1)
+        if not path.is_file():
+            return paths
+        paths.append(str(path))
+
+
+def _new_book(
+    title: str, author: str, summary: Tag, cover: str, volume: int = None
+) -> Tuple[epub.EpubBook, epub.EpubHtml]:
+    """Start a book with its metadata and cover. Return it and its summary"""
     # To ensure every book has unique id, making hash with title and author
     book_id = sha256(bytes(f"{title} by {author}", "utf-8")).hexdigest()
 
     book = epub.EpubBook()
 
     # Add metadata
-    book.set_identifier(book_id)
+    if volume is None:
+        book.set_identifier(book_id)
+        book.set_title(title)
+    else:
+        # Numbered after the story's id, so every volume's id is stable too
+        book.set_identifier(f"{book_id}-{volume}")
+        book.set_title(f"{title}, Volume {volume}")
+        # Lets readers (e.g. calibre) shelve the volumes together, in order
+        for name, content in (
+            ("calibre:series", title),
+            ("calibre:series_index", str(volume)),
+        ):
+            book.add_metadata(
+                "OPF", "meta", "", {"name": name, "content": content}
+            )
     book.set_cover(
         cover,
         open(cover, "rb").read(),
         create_page=True,
     )
-    book.set_title(title)
     book.set_language("en")
     book.add_author(author)
 
@@ -37,21 +81,38 @@ def create_epub(
         content=str(summary),
     )
 
-    book.add_item(intro)
+    return book, intro
 
-    chapter_objects = []
-    chapter_objects.append(intro)
-    for ch in chapters:
-        ch_temp = epub.EpubHtml(
-            title=ch[0],
-            file_name=f"{ch[0]}.xhtml",
-            lang="en",
-            content=str(ch[1]),
-        )
-        chapter_objects.append(ch_temp)
 
-        book.add_item(ch_temp)
+def _chapter_item(chapter: CHAPTER_DATA) -> epub.EpubHtml:
+    return epub.EpubHtml(
+        title=chapter[0],
+        file_name=f"{chapter[0]}.xhtml",
+        lang="en",
+        content=str(chapter[1]),
+    )
+
+
+def _add_chapter(
+    writer: "_StreamingWriter",
+    item: epub.EpubHtml,
+    images: Optional[ImageStore],
+) -> None:
+    """Write a chapter, after the packaged images it shows not yet written"""
+    if images is not None:
+        for image in images.referenced(item.content):
+            if image.id not in writer.streamed:
+                writer.add(image)
+    writer.add(item)
+
 
+def _finish_book(
+    book: epub.EpubBook,
+    chapter_objects: List[epub.EpubHtml],
+    chapter_urls: Optional[List[str]],
+    story_url: Optional[str],
+) -> None:
+    """Add the table of contents, style, spine, and chapter manifest"""
     # Create table of contents and navigational components
     book.toc = chapter_objects
     book.add_item(epub.EpubNcx())
@@ -70,13 +131,289 @@ def create_epub(
 
     book.spine = ["nav"] + chapter_objects
 
-    name = re.sub("[ /]+", "-", f"{title} by {author}.epub")
+    if chapter_urls is not None:
+        manifest = {
+            "story_url": story_url,
+            "chapters": [
+                [url, ch_object.title, ch_object.file_name]
+                for url, ch_object in zip(chapter_urls, chapter_objects[1:])
+            ],
+        }
+        book.add_metadata(
+            "OPF",
+            "meta",
+            "",
+            {"name": MANIFEST_META, "content": json.dumps(manifest)},
+        )
+
+
+def create_epub(
+    title: str,
+    author: str,
+    summary: Tag,
+    chapters: CHAPTER,
+    cover: str,
+    chapter_urls: List[str] = None,
+    story_url: str = None,
+) -> tuple[epub.EpubBook, str]:
+    """Following the ebooklib docs, assemble and write ebook
+
+    When given the chapters' urls, they are recorded in the book's metadata
+    so a later update can tell which chapters it already has.
+    """
+    with metrics.STAGE_SECONDS.time(stage="assemble"):
+        book, intro = _new_book(title, author, summary, cover)
+        book.add_item(intro)
+
+        chapter_objects = [intro]
+        for ch in chapters:
+            ch_temp = _chapter_item(ch)
+            chapter_objects.append(ch_temp)
+
+            book.add_item(ch_temp)
+
+        _finish_book(book, chapter_objects, chapter_urls, story_url)
+
+    return book, ebook_name(title, author)
+
+
+class _StreamingWriter(epub.EpubWriter):
+    """Writes each chapter into the epub's zip as soon as it is added
+
+    Afterwards only a chapter's title and file name are kept, for the table
+    of contents, spine, and OPF, which finish() writes once all are added.
+    """
+
+    def __init__(self, dst_file: BinaryIO, book: epub.EpubBook) -> None:
+        super().__init__(dst_file, book, {})
+        self.streamed = set()
+
+        self.out = zipfile.ZipFile(
+            dst_file,
+            "w",
+            zipfile.ZIP_DEFLATED,
+            compresslevel=settings.zip_compression_level,
+        )
+        self.out.writestr(
+            "mimetype",
+            "application/epub+zip",
+            compress_type=zipfile.ZIP_STORED,
+        )
+        self._write_container()
+
+    def add(self, item: epub.EpubItem) -> None:
+        self.book.add_item(item)
+        with metrics.STAGE_SECONDS.time(stage="assemble"):
+            content = item.get_content()
+        with metrics.STAGE_SECONDS.time(stage="write"):
+            self.out.writestr(
+                f"{self.book.FOLDER_NAME}/{item.file_name}", content
+            )
+        item.content = ""
+        self.streamed.add(item.id)
+
+    def finish(self) -> None:
+        """Write the OPF, navigation, and every item not yet written"""
+        with metrics.STAGE_SECONDS.time(stage="write"):
+            self._write_opf()
+
+            items = self.book.items
+            self.book.items = [
+                item for item in items if item.id not in self.streamed
+            ]
+            try:
+                self._write_items()
+            finally:
+                self.book.items = items
+
+
+def _write_into(
+    dst: Union[str, BinaryIO], name: str, write: Callable[[BinaryIO], None]
+) -> None:
+    """Have write fill the ebook, in directory dst or file object dst"""
+    if not isinstance(dst, (str, PathLike)):
+        fte_print(f"Writing ebook: {name} to memory", settings.verbosity)
+        write(dst)
+        return
+
+    fte_print(f"Writing ebook: {name} to {dst}", settings.verbosity)
+    # Written beside its destination, and only moved there once complete,
+    # so a failed build never leaves half an ebook (or loses an old one)
+    with NamedTemporaryFile(dir=dst, suffix=".tmp", delete=False) as tmp_file:
+        try:
+            write(tmp_file)
+        except BaseException:
+            tmp_file.close()
+            os.unlink(tmp_file.name)
+            raise
+
+    os.replace(tmp_file.name, Path(dst) / name)
+
+
+def write_ebook(
+    ebook: epub.EpubBook, name: str, dst: Union[str, BinaryIO]
+) -> None:
+    """Writes the ebook to the specified directory, or into a file object
+
+    A file object (e.g. io.BytesIO) lets the ebook be built without ever
+    touching the disk.
+    """
+
+    def write(dst_file: BinaryIO) -> None:
+        epub.write_epub(dst_file, ebook, {})
+
+    with metrics.STAGE_SECONDS.time(stage="write"):
+        _write_into(dst, name, write)
+
+
+def stream_epub(
+    title: str,
+    author: str,
+    summary: Tag,
+    chapters: CHAPTER,
+    cover: str,
+    dst: Union[str, BinaryIO],
+    chapter_urls: List[str] = None,
+    story_url: str = None,
+    images: ImageStore = None,
+) -> str:
+    """Assemble the ebook into dst as its chapters arrive. Return its name
+
+    The same ebook as create_epub and write_ebook make, but each chapter is
+    written as soon as chapters yields it and then dropped, so a story of
+    thousands of chapters is built in flat memory. With images, the images
+    the chapters show (see ImageStore.embed) are packaged too.
+    """
+    name = ebook_name(title, author)
+    book, intro = _new_book(title, author, summary, cover)
+
+    def write(dst_file: BinaryIO) -> None:
+        writer = _StreamingWriter(dst_file, book)
+        try:
+            writer.add(intro)
+            chapter_objects = [intro]
+            for ch in chapters:
+                chapter_objects.append(_chapter_item(ch))
+                _add_chapter(writer, chapter_objects[-1], images)
+
+            _finish_book(book, chapter_objects, chapter_urls, story_url)
+            writer.finish()
+        finally:
+            writer.out.close()
+
+    _write_into(dst, name, write)
+    return name
+
+
+def stream_volumes(
+    title: str,
+    author: str,
+    summary: Tag,
+    chapters: CHAPTER,
+    cover: str,
+    dst: str,
+    chapter_urls: List[str] = None,
+    story_url: str = None,
+    max_chapters: int = 0,
+    max_bytes: int = 0,
+    images: ImageStore = None,
+) -> List[str]:
+    """Like stream_epub, but split the story into volumes. Return their names
+
+    A volume holds at most max_chapters chapters, and chapters of at most
+    max_bytes bytes of html (but always at least one chapter). 0 is no
+    limit. Each volume is written into directory dst as soon as its last
+    chapter is in, while the later volumes' chapters are still scraped.
+    Every volume packages its own copy of the images its chapters show.
+    """
+
+    def numbered() -> Iterator[Tuple[int, epub.EpubHtml, int]]:
+        for index, ch in enumerate(chapters):
+            item = _chapter_item(ch)
+            yield index, item, len(item.content.encode("utf-8"))
+
+    remaining = numbered()
+    pending = next(remaining, None)  # the next volume's first chapter
+    names = []
+
+    while pending is not None or not names:
+        volume = len(names) + 1
+        name = ebook_name(title, author, volume)
+        book, intro = _new_book(title, author, summary, cover, volume)
+
+        def write(dst_file: BinaryIO) -> None:
+            nonlocal pending
+            writer = _StreamingWriter(dst_file, book)
+            try:
+                writer.add(intro)
+                chapter_objects = [intro]
+                volume_urls = [] if chapter_urls is not None else None
+                volume_bytes = 0
+                while pending is not None:
+                    index, item, size = pending
+                    full = max_bytes and volume_bytes + size > max_bytes
+                    if full and len(chapter_objects) > 1:
+                        break
+
+                    _add_chapter(writer, item, images)
+                    chapter_objects.append(item)
+                    if volume_urls is not None:
+                        volume_urls.append(chapter_urls[index])
+                    volume_bytes += size
+
+                    if len(chapter_objects) - 1 == max_chapters:
+                        # Finish the volume without waiting on the next one
+                        pending = None
+                        break
+                    pending = next(remaining, None)
+
+                _finish_book(book, chapter_objects, volume_urls, story_url)
+                writer.finish()
+            finally:
+                writer.out.close()
+
+        _write_into(dst, name, write)
+        names.append(name)
+
+        if pending is None:
+            pending = next(remaining, None)
+
+    return names
+
+
+def read_manifest(book: epub.EpubBook) -> Optional[dict]:
+    """Return the chapter manifest fte stored in the book, if there is one"""
+    # ebooklib versions differ on what they file <meta name=...> under
+    for entries in book.metadata.get(epub.NAMESPACES["OPF"], {}).values():
+        for _, attributes in entries:
+            if attributes.get("name") == MANIFEST_META:
+                return json.loads(attributes["content"])
+    return None
+
+
+def read_known_chapters(path: str) -> KNOWN_CHAPTERS:
+    """Load the chapters of an ebook fte made before, keyed by their url"""
+    if not Path(path).is_file():
+        return {}
 
-    return book, name
+    book = epub.read_epub(path)
+    manifest = read_manifest(book)
+    if manifest is None:
+        fte_print(f"{path} has no chapter manifest", settings.verbosity)
+        return {}
 
+    known = {}
+    for url, title, file_name in manifest["chapters"]:
+        item = book.get_item_with_href(file_name)
+        if item is None:
+            continue
+        # The stored document is a whole xhtml page. Keep only its body
+        with warnings.catch_warnings():
+            # xhtml is fine to parse as html; only lxml complains about it
+            warnings.simplefilter("ignore", XMLParsedAsHTMLWarning)
+            page = parse_html(item.get_content(), SoupStrainer("body"))
+        body = page.find("body")
+        if body is not None:
+            known[url] = (title, body)
 
-def write_ebook(ebook: epub.EpubBook, name: str, dst_dir: str) -> None:
-    """Writes the ebook to the specified directory"""
-    fte_print(f"Writing ebook: {name} to {dst_dir}", settings.verbosity)
-    epub.write_epub(name, ebook, {})
-    move(name, f"{dst_dir}/{name}")
+    return known
@@ -1,15 +1,26 @@
 import argparse
+import os
+import sys
+from time import monotonic
 
 from pathlib import Path
+from shutil import copyfileobj
+from threading import Lock
 from urllib.parse import urlparse, ParseResult
-from typing import Tuple
+from typing import BinaryIO, Callable, List, Tuple, Union
 
+import metrics
 import settings
-from utility import CHAPTER, fte_print
-from ebook import create_epub, write_ebook
-from scraper import spacebattles, archiveofourown
+from utility import CHAPTER, CHAPTER_DATA, CHAPTER_REFS, KNOWN_CHAPTERS
+from utility import ON_CHAPTER, PROGRESS, STORY_INDEX, fte_print
+from batch import print_summary, read_urls, run_batch
+from checkpoint import Checkpoint
+from shared import get_shared_store
 
-from bs4.element import Tag
+# A site's chapter gathering function. See scraper.spacebattles_chapters
+CHAPTER_GATHERER = Callable[
+    [CHAPTER_REFS, KNOWN_CHAPTERS, ON_CHAPTER], CHAPTER
+]
 
 
 def _validate_url_pieces(pieces: ParseResult) -> None:
@@ -34,18 +45,72 @@ def _validate_dst_dir(dst_dir: str) -> None:
         raise Exception("Invalid destination directory.")
 
 
-def _gather_story_data(
-    url_pieces: ParseResult, full_url: str
-) -> Tuple[str, str, Tag, CHAPTER]:
-    """Pick the appropriate gathering function, execute it, and return data"""
+def _get_site_scrapers(
+    url_pieces: ParseResult,
+) -> Tuple[Callable[[str], STORY_INDEX], CHAPTER_GATHERER]:
+    """Pick the site's index and chapter gathering functions"""
+    # Imported only now, so a bad url fails before bs4, requests, etc. load
+    import scraper
+
     # By using a dictionary, will avoid long if-else chain
     WEBSITES = {
-        "forums.spacebattles.com": spacebattles,
-        "archiveofourown.org": archiveofourown,
+        "forums.spacebattles.com": (
+            scraper.spacebattles_index,
+            scraper.spacebattles_chapters,
+        ),
+        "archiveofourown.org": (
+            scraper.archiveofourown_index,
+            scraper.archiveofourown_chapters,
+        ),
         # Add more functions here as more sites are supported
     }
 
-    return WEBSITES[url_pieces.netloc](full_url)
+    return WEBSITES[url_pieces.netloc]
+
+
+def _gather_chapters(
+    get_chapters: CHAPTER_GATHERER,
+    chapter_refs: CHAPTER_REFS,
+    old_ebooks: List[str] = None,
+    checkpoint: Checkpoint = None,
+    progress: PROGRESS = None,
+) -> CHAPTER:
+    """Execute the site's chapter gathering function, and return chapters
+
+    With old_ebooks, chapters already in those ebooks are reused instead of
+    scraped again. With checkpoint, so are the chapters an earlier failed
+    attempt saved, and every newly scraped chapter is saved to it.
+    progress is told how many chapters are ready.
+    """
+    from ebook import read_known_chapters
+
+    known = {}
+    if checkpoint is not None:
+        known = checkpoint.load()
+
+    if old_ebooks is not None:
+        for old_ebook in old_ebooks:
+            known.update(read_known_chapters(old_ebook))
+        fte_print(
+            f"Reusing {len(known)} of {len(chapter_refs)} chapters",
+            settings.verbosity,
+        )
+
+    ready = len({ch_url for ch_url, _ in chapter_refs} & known.keys())
+    ready_lock = Lock()
+    if progress is not None:
+        progress(ready, len(chapter_refs))
+
+    def on_chapter(ch_url: str, chapter: CHAPTER_DATA) -> None:
+        nonlocal ready
+        if checkpoint is not None:
+            checkpoint.save(ch_url, chapter)
+        if progress is not None:
+            with ready_lock:
+                ready += 1
+                progress(ready, len(chapter_refs))
+
+    return get_chapters(chapter_refs, known, on_chapter)
 
 
 def _get_cover_name(url: str) -> str:
@@ -57,35 +122,201 @@ def _get_cover_name(url: str) -> str:
     return COVERS[url_pieces.netloc]
 
 
-def main(url: str, verbosity: bool = False, dst_dir: str = ".") -> None:
-    """The start function. Validates url, gathers data, and creates ebook"""
+def main(
+    url: str,
+    verbosity: bool = False,
+    dst_dir: str = ".",
+    workers: int = None,
+    cache_dir: str = None,
+    update: bool = False,
+    progress: PROGRESS = None,
+    dst_file: BinaryIO = None,
+    volume_chapters: int = None,
+    volume_mb: float = None,
+    images: bool = None,
+    sanitize: bool = None,
+) -> Union[str, List[str]]:
+    """The start function. Validates url, gathers data, and creates ebook
+
+    With update, an ebook of the story already in dst_dir only has its new
+    chapters scraped. progress is called with how many of the story's
+    chapters are ready, and how many there are. With dst_file, the ebook
+    is written into that file object instead of dst_dir. With
+    volume_chapters or volume_mb, a story written to dst_dir is split
+    into volumes of at most that many chapters or megabytes. images sets
+    whether the chapters' images are downloaded into the ebook, and
+    sanitize whether chapters are stripped down to their plain html.
+    These four default to settings, which they leave unchanged. Returns
+    the ebook's path, or only its name when given dst_file, or the paths
+    of the volumes.
+    """
     settings.verbosity = verbosity
+    if workers is not None:
+        settings.max_workers = workers
+    if cache_dir is not None:
+        settings.cache_dir = cache_dir
+    # This build's own options. settings only holds their defaults
+    if volume_chapters is None:
+        volume_chapters = settings.volume_chapters
+    volume_bytes = settings.volume_bytes
+    if volume_mb is not None:
+        volume_bytes = int(volume_mb * 1024**2)
+    if images is None:
+        images = settings.embed_images
+    if sanitize is None:
+        sanitize = settings.sanitize
+    # A file object only holds one ebook
+    volumes = dst_file is None and (volume_chapters > 0 or volume_bytes > 0)
 
     url_pieces = urlparse(url)
     _validate_url_pieces(url_pieces)
     _validate_dst_dir(dst_dir)
+    # Heavy, so only imported once the input is known to be good
+    from ebook import ebook_name, stream_epub, stream_volumes, volume_paths
+    from images import ImageStore
+    from sanitize import sanitize_chapters
+
+    with metrics.timed_build():
+        get_index, get_chapters = _get_site_scrapers(url_pieces)
+        cover = _get_cover_name(url)
+
+        fte_print("Starting metadata collection", settings.verbosity)
+        title, author, summary, chapter_refs = get_index(url)
+        chapter_urls = [ch_url for ch_url, _ in chapter_refs]
+
+        def build(dst: Union[str, BinaryIO]) -> Union[str, List[str]]:
+            checkpoint = None
+            if settings.checkpoint_dir:
+                checkpoint = Checkpoint(settings.checkpoint_dir, url)
 
-    cover = _get_cover_name(url)
-    fte_print("Starting metadata collection", settings.verbosity)
-    ebook, name = create_epub(*_gather_story_data(url_pieces, url), cover)
-    write_ebook(ebook, name, dst_dir)
+            old_ebooks = None
+            if update:
+                # Whole or in volumes, so the split can change between builds
+                old_ebooks = [str(Path(dst_dir) / ebook_name(title, author))]
+                old_ebooks += volume_paths(dst_dir, title, author)
+
+            chapters = _gather_chapters(
+                get_chapters,
+                chapter_refs,
+                old_ebooks=old_ebooks,
+                checkpoint=checkpoint,
+                progress=progress,
+            )
+
+            if sanitize:
+                chapters = sanitize_chapters(chapters, title)
+
+            # Reused chapters may show the images their old ebook packaged,
+            # so those are packaged again, even without images
+            image_store = None
+            if images or old_ebooks:
+                image_store = ImageStore()
+                for old_ebook in old_ebooks or []:
+                    image_store.load_ebook(old_ebook)
+            if images:
+                chapters = image_store.embed(chapters, chapter_urls)
+
+            # Chapters are written into the ebook as they are scraped
+            if volumes:
+                name = stream_volumes(
+                    title,
+                    author,
+                    summary,
+                    chapters,
+                    cover,
+                    dst,
+                    chapter_urls=chapter_urls,
+                    story_url=url,
+                    max_chapters=volume_chapters,
+                    max_bytes=volume_bytes,
+                    images=image_store,
+                )
+            else:
+                name = stream_epub(
+                    title,
+                    author,
+                    summary,
+                    chapters,
+                    cover,
+                    dst,
+                    chapter_urls=chapter_urls,
+                    story_url=url,
+                    images=image_store,
+                )
+
+            if checkpoint is not None:
+                checkpoint.clear()
+
+            return name
+
+        if volumes:
+            # Several files, so built straight into dst_dir, and never shared
+            names = build(dst_dir)
+            # Volumes left over from an earlier, longer split, and the
+            # whole ebook from before the story was split
+            stale = [
+                path
+                for path in volume_paths(dst_dir, title, author)
+                if Path(path).name not in names
+            ]
+            stale.append(str(Path(dst_dir) / ebook_name(title, author)))
+            for path in stale:
+                if Path(path).is_file():
+                    os.remove(path)
+            return [str(Path(dst_dir) / name) for name in names]
+
+        store = get_shared_store()
+        if store is None:
+            name = build(dst_file if dst_file is not None else dst_dir)
+        else:
+            # Only one replica builds the story. Everyone copies the stored one
+            options = [
+                f"images={images}",
+                f"image_max_size={settings.image_max_size}",
+                f"image_quality={settings.image_quality}",
+                f"sanitize={sanitize}",
+                f"zip_compression_level={settings.zip_compression_level}",
+            ]
+            with store.build_once(
+                url, chapter_urls, build, options
+            ) as shared_file:
+                name = Path(shared_file.name).name
+                if dst_file is not None:
+                    copyfileobj(shared_file, dst_file)
+                else:
+                    with open(Path(dst_dir) / name, "wb") as ebook_file:
+                        copyfileobj(shared_file, ebook_file)
+
+        if dst_file is not None:
+            return name
+        # The volumes from before the story stopped being split
+        for path in volume_paths(dst_dir, title, author):
+            os.remove(path)
+        return str(Path(dst_dir) / name)
 
 
 if __name__ == "__main__":
     """Cli interface for direct execution"""
     parser = argparse.ArgumentParser(
         description="""Turn fanfictions into ebooks(.epub) with their url.
-        Requires the host machine to have firefox (browser) installed
-        and the program's directory to have the geckodriver (executable)""",
+        Some spacebattles stories fall back to firefox (browser), which then
+        needs the program's directory to have the geckodriver (executable)""",
     )
 
-    parser.add_argument(
+    stories = parser.add_mutually_exclusive_group(required=True)
+    stories.add_argument(
         "-u",
         "--url",
-        required=True,
         help="The full url [http(s)://<NETLOC>/<PATH>] to the story's page",
     )
 
+    stories.add_argument(
+        "-b",
+        "--batch",
+        help="A file of story urls, one per line, or - to read them from "
+        "stdin. Builds them all in one run and prints a summary.",
+    )
+
     parser.add_argument(
         "-v",
         "--verbosity",
@@ -100,6 +331,87 @@ if __name__ == "__main__":
         default=".",
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="How many chapters to download at the same time.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        help="Directory to cache downloaded pages in, for faster rebuilds.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Only download chapters missing from the destination's ebook.",
+    )
+
+    parser.add_argument(
+        "--images",
+        action="store_true",
+        default=None,
+        help="Download the chapters' images into the ebook, scaled down.",
+    )
+
+    parser.add_argument(
+        "--sanitize",
+        action="store_true",
+        default=None,
+        help="Strip chapters down to plain html: no scripts, styles, site "
+        "markup, or extra whitespace.",
+    )
+
+    parser.add_argument(
+        "--volume-chapters",
+        type=int,
+        help="Split the story into ebooks of at most this many chapters.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--volume-mb",
+        type=float,
+        help="Split the story into ebooks of at most this many megabytes of "
+        "chapters.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-s",
+        "--stories",
+        type=int,
+        help="With --batch, how many stories to build at the same time.",
+        default=None,
+    )
+
     args = parser.parse_args()
 
-    main(args.url, verbosity=args.verbosity, dst_dir=args.destination)
+    options = dict(
+        verbosity=args.verbosity,
+        dst_dir=args.destination,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        update=args.update,
+        volume_chapters=args.volume_chapters,
+        volume_mb=args.volume_mb,
+        images=args.images,
+        sanitize=args.sanitize,
+    )
+
+    if args.batch is None:
+        main(args.url, **options)
+        print(f"\n{metrics.summary()}")
+    else:
+        start = monotonic()
+        results = run_batch(
+            main, read_urls(args.batch), stories=args.stories, **options
+        )
+        print_summary(results, monotonic() - start)
+        print(f"\n{metrics.summary()}")
+        sys.exit(any(error is not None for _, _, error, _ in results))
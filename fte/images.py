@@ -0,0 +1,219 @@
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import metrics
+import network
+import settings
+from utility import CHAPTER, fte_print, parse_fragment
+
+from bs4 import BeautifulSoup
+from ebooklib import epub
+
+# Where, inside the ebook, embedded images are kept. Chapters link to them
+# relative to themselves, as src="images/<file name>"
+IMAGE_DIR = "images"
+IMAGE_SRC = re.compile(rf'src="{IMAGE_DIR}/([^"]+)"')
+
+# The first bytes of each image format an ebook can hold, and their types
+MAGIC_NUMBERS = (
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"GIF87a", "image/gif", ".gif"),
+    (b"GIF89a", "image/gif", ".gif"),
+)
+WEBP = ("image/webp", ".webp")
+
+
+def _image_type(data: bytes) -> Optional[Tuple[str, str]]:
+    """The media type and extension of image data, or None if unsupported"""
+    for magic, media_type, extension in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return media_type, extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return WEBP
+    return None
+
+
+def _shrink(data: bytes) -> bytes:
+    """Downscale and recompress an image, when Pillow is installed
+
+    Images are scaled down to fit settings.image_max_size pixels, and kept
+    in whichever of their original or recompressed data is smaller.
+    Animated images are left alone.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if getattr(image, "is_animated", False):
+                return data
+
+            size = settings.image_max_size
+            resized = image.width > size or image.height > size
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            # Photos become jpegs. Anything transparent stays a png
+            shrunk = BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(shrunk, "PNG", optimize=True)
+            else:
+                image.convert("RGB").save(
+                    shrunk,
+                    "JPEG",
+                    quality=settings.image_quality,
+                    optimize=True,
+                )
+    except (OSError, ValueError):  # corrupt, or not really an image
+        return data
+
+    if resized or shrunk.tell() < len(data):
+        return shrunk.getvalue()
+    return data
+
+
+class ImageStore:
+    """The images embedded in one story's ebook(s)
+
+    Each image is downloaded once, however many chapters show it, and
+    stored once per distinct content (by its sha256), so the signatures
+    and banners repeated across chapters are packaged a single time.
+    """
+
+    def __init__(self) -> None:
+        # url -> its download, whose result is its file name
+        self._files: Dict[str, Future] = {}
+        self._digests: Dict[str, str] = {}  # original's sha256 -> file name
+        self._data: Dict[str, Tuple[str, bytes]] = {}  # file name -> image
+        self._lock = Lock()
+
+    def load_ebook(self, path: str) -> None:
+        """Reuse the images an ebook fte made before has packaged"""
+        if not Path(path).is_file():
+            return
+
+        for item in epub.read_epub(path).get_items():
+            if item.file_name.startswith(f"{IMAGE_DIR}/"):
+                name = Path(item.file_name).name
+                self._digests[Path(name).stem] = name
+                self._data[name] = (item.media_type, item.get_content())
+
+    def _download(self, url: str) -> Optional[str]:
+        """Fetch, shrink, and store the image at url. Return its file name"""
+        try:
+            response = network.get(url, fresh_ok=True)
+        except Exception as e:
+            fte_print(f"Image unreachable: {url}. {e}", settings.verbosity)
+            metrics.IMAGES.inc(result="failed")
+            return None
+
+        image_type = _image_type(response.content)
+        if response.status_code != 200 or image_type is None:
+            fte_print(f"Not an image: {url}", settings.verbosity)
+            metrics.IMAGES.inc(result="failed")
+            return None
+
+        # Named after the original, so it's found before shrinking it again
+        digest = sha256(response.content).hexdigest()
+        with self._lock:
+            if digest in self._digests:
+                metrics.IMAGES.inc(result="duplicate")
+                return self._digests[digest]
+
+        with metrics.STAGE_SECONDS.time(stage="images"):
+            data = _shrink(response.content)
+        media_type, extension = _image_type(data) or image_type
+        name = f"{digest}{extension}"
+
+        with self._lock:
+            self._digests[digest] = name
+            self._data[name] = (media_type, data)
+        metrics.IMAGES.inc(result="downloaded")
+        saved = len(response.content) - len(data)
+        metrics.IMAGE_BYTES_SAVED.inc(max(saved, 0))
+        return name
+
+    def _find_images(
+        self, html: str, chapter_url: str, pool: ThreadPoolExecutor
+    ) -> Tuple[str, Optional[BeautifulSoup], list]:
+        """Parse a chapter's <img>s, and start downloading the new images"""
+        if "<img" not in html:
+            return html, None, []
+
+        with metrics.STAGE_SECONDS.time(stage="parse"):
+            page = parse_fragment(html)
+        imgs = []
+        for img in page.find_all("img"):
+            # Lazy loaded images keep their real url out of src
+            src = img.get("data-src") or img.get("data-url") or img.get("src")
+            if src and not src.startswith(("data:", f"{IMAGE_DIR}/")):
+                url = urljoin(chapter_url, src)
+                if url not in self._files:
+                    self._files[url] = pool.submit(self._download, url)
+                imgs.append((img, url))
+        return html, page, imgs
+
+    def _point_at_images(
+        self, html: str, page: Optional[BeautifulSoup], imgs: list
+    ) -> str:
+        """Point a chapter's <img>s at their images, once downloaded"""
+        if not imgs:
+            return html
+
+        for img, url in imgs:
+            name = self._files[url].result()
+            if name is None:
+                continue  # left pointing at the site
+            img["src"] = f"{IMAGE_DIR}/{name}"
+            for attribute in ("data-src", "data-url", "srcset"):
+                if attribute in img.attrs:
+                    del img[attribute]
+
+        return str(page)
+
+    def embed(self, chapters: CHAPTER, chapter_urls: List[str]) -> CHAPTER:
+        """Download every chapter's images, pointing its <img>s at them
+
+        chapter_urls are the chapters' own urls, in the same order, which
+        relative image urls are resolved against. Images that can't be
+        downloaded are left as they were. The images of the next few
+        chapters download together, while earlier chapters are written.
+        """
+        workers = max(settings.max_workers, 1)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        waiting = deque()
+        try:
+            for (name, content), chapter_url in zip(chapters, chapter_urls):
+                found = self._find_images(str(content), chapter_url, pool)
+                waiting.append((name, found))
+                if len(waiting) > workers:
+                    name, found = waiting.popleft()
+                    yield name, self._point_at_images(*found)
+
+            while waiting:
+                name, found = waiting.popleft()
+                yield name, self._point_at_images(*found)
+        finally:
+            # Also reached when the build fails, or stops early
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def referenced(self, html: str) -> Iterator[epub.EpubImage]:
+        """The packaged images html shows"""
+        for name in IMAGE_SRC.findall(html):
+            image = self._data.get(name)
+            if image is not None:
+                yield epub.EpubImage(
+                    uid=f"image_{Path(name).stem}",
+                    file_name=f"{IMAGE_DIR}/{name}",
+                    media_type=image[0],
+                    content=image[1],
+                )
@@ -0,0 +1,266 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple
+
+LABELS = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: LABELS, values: LABELS, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(v)}"' for name, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A total that only goes up, kept per combination of label values"""
+
+    def __init__(self, name: str, help: str, labels: LABELS = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[LABELS, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[LABELS, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+        ]
+        for key, value in sorted(self.values().items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, key)} {value:g}"
+            )
+        return lines
+
+
+class Histogram:
+    """Observed values counted into buckets, per combination of labels"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: LABELS = (),
+        buckets: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., count, sum]
+        self._values: Dict[LABELS, List[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            counts = self._values.setdefault(
+                key, [0] * (len(self.buckets) + 2)
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe how many seconds the with block takes"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def totals(self) -> Dict[LABELS, Tuple[int, float]]:
+        """Return how many values were observed, and their sum, by labels"""
+        with self._lock:
+            return {
+                key: (int(counts[-2]), counts[-1])
+                for key, counts in self._values.items()
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = {key: list(c) for key, c in self._values.items()}
+
+        for key, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                bucket = _format_labels(self.labels, key, f'le="{bound:g}"')
+                lines.append(f"{self.name}_bucket{bucket} {count:g}")
+            bucket = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket} {counts[-2]:g}")
+
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_count{labels} {counts[-2]:g}")
+            lines.append(f"{self.name}_sum{labels} {counts[-1]:g}")
+        return lines
+
+
+REQUESTS = Counter(
+    "fte_requests_total",
+    "HTTP responses received, by host and status code.",
+    ("host", "status"),
+)
+RESPONSE_BYTES = Counter(
+    "fte_response_bytes_total",
+    "Bytes of HTTP response bodies received, by host.",
+    ("host",),
+)
+REQUEST_SECONDS = Histogram(
+    "fte_request_seconds",
+    "Seconds each HTTP request took, by host.",
+    ("host",),
+)
+CACHE_LOOKUPS = Counter(
+    "fte_cache_lookups_total",
+    "Page cache lookups, by host and result (fresh, revalidated, miss).",
+    ("host", "result"),
+)
+RATE_LIMITED = Counter(
+    "fte_rate_limited_total",
+    "Rate limited (429) responses, by host.",
+    ("host",),
+)
+RATE_LIMIT_WAIT = Counter(
+    "fte_rate_limit_wait_seconds_total",
+    "Seconds spent waiting for a host's rate limit, by host.",
+    ("host",),
+)
+STAGE_SECONDS = Histogram(
+    "fte_stage_seconds",
+    "Seconds spent in each build stage (fetch, parse, sanitize, images, "
+    "assemble, write, build).",
+    ("stage",),
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 5, 10, 60, 300),
+)
+IMAGES = Counter(
+    "fte_images_total",
+    "Images embedded in ebooks, by result (downloaded, duplicate, failed).",
+    ("result",),
+)
+IMAGE_BYTES_SAVED = Counter(
+    "fte_image_bytes_saved_total",
+    "Bytes removed from embedded images by downscaling and recompressing.",
+)
+HTML_BYTES = Counter(
+    "fte_html_bytes_total",
+    "Bytes of chapter html passed through the sanitizer, by state (scraped, "
+    "sanitized).",
+    ("state",),
+)
+BUILDS = Counter(
+    "fte_builds_total",
+    "Ebook builds, by result (finished, failed).",
+    ("result",),
+)
+
+ALL = (
+    REQUESTS,
+    RESPONSE_BYTES,
+    REQUEST_SECONDS,
+    CACHE_LOOKUPS,
+    RATE_LIMITED,
+    RATE_LIMIT_WAIT,
+    STAGE_SECONDS,
+    IMAGES,
+    IMAGE_BYTES_SAVED,
+    HTML_BYTES,
+    BUILDS,
+)
+
+
+@contextmanager
+def timed_build() -> Iterator[None]:
+    """Time a whole ebook build, and count whether it finished or failed"""
+    try:
+        with STAGE_SECONDS.time(stage="build"):
+            yield
+    except BaseException:
+        BUILDS.inc(result="failed")
+        raise
+    BUILDS.inc(result="finished")
+
+
+def reset() -> None:
+    """Forget everything recorded so far"""
+    for metric in ALL:
+        metric.clear()
+
+
+def render() -> str:
+    """Every metric, in the Prometheus text exposition format"""
+    lines = [line for metric in ALL for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """A short, human readable report of where the time went"""
+    stages = ", ".join(
+        f"{stage} {seconds:.2f}s"
+        for (stage,), (_, seconds) in STAGE_SECONDS.totals().items()
+    )
+    lines = [f"Time by stage, summed over threads: {stages or 'none'}"]
+
+    requests: Dict[str, int] = {}
+    for (host, _), count in REQUESTS.values().items():
+        requests[host] = requests.get(host, 0) + int(count)
+    received = {host: n for (host,), n in RESPONSE_BYTES.values().items()}
+    latency = {host: n for (host,), n in REQUEST_SECONDS.totals().items()}
+    cache = CACHE_LOOKUPS.values()
+    limited = {host: n for (host,), n in RATE_LIMITED.values().items()}
+    waited = {host: n for (host,), n in RATE_LIMIT_WAIT.values().items()}
+
+    for host in sorted(requests):
+        count, seconds = latency.get(host, (0, 0.0))
+        hits = sum(
+            hits
+            for (cache_host, result), hits in cache.items()
+            if cache_host == host and result != "miss"
+        )
+        lines.append(
+            f"{host}: {requests[host]} requests, "
+            f"{received.get(host, 0) / 1024**2:.1f} MB, "
+            f"avg {seconds / count if count else 0:.2f}s, "
+            f"{int(hits)} cache hits, {int(limited.get(host, 0))} rate "
+            f"limited, {waited.get(host, 0):.1f}s waiting for rate limits"
+        )
+
+    html = HTML_BYTES.values()
+    scraped = html.get(("scraped",), 0)
+    if scraped:
+        sanitized = html.get(("sanitized",), 0)
+        lines.append(
+            f"Sanitized chapter html: {scraped / 1024**2:.1f} MB became "
+            f"{sanitized / 1024**2:.1f} MB "
+            f"({100 * (1 - sanitized / scraped):.0f}% saved)"
+        )
+
+    return "\n".join(lines)
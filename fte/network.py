@@ -0,0 +1,183 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import settings
+from cache import get_cache
+from ratelimit import bucket_for
+from utility import fte_print
+from workers import host_slot
+
+
+try:
+    import brotli  # noqa: F401  (lets urllib3 decode "br" responses)
+
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+_session = None
+_session_lock = Lock()
+
+
+def _new_session() -> requests.Session:
+    """Make a session with pooled keep-alive connections and retries"""
+    retries = Retry(
+        total=settings.http_retries,
+        backoff_factor=settings.http_retry_backoff,
+        # Rate limiting (429) is left to the per host token buckets
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.pooled_hosts,
+        pool_maxsize=max(
+            settings.max_workers,
+            settings.default_host_concurrency,
+            *settings.host_concurrency.values(),
+        ),
+        max_retries=retries,
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the process wide session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _new_session()
+        return _session
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """Seconds the Retry-After header asks for, if it is present and valid"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    if value.strip().isdigit():
+        return float(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _route(url: str) -> str:
+    """The url to request, with its host swapped per settings.host_overrides
+
+    Everything else (limits, cache, ...) still goes by the original url.
+    """
+    pieces = urlsplit(url)
+    base = settings.host_overrides.get(pieces.netloc)
+    if base is None:
+        return url
+
+    query = f"?{pieces.query}" if pieces.query else ""
+    return f"{base.rstrip('/')}{pieces.path}{query}"
+
+
+def _fetch(url: str, **kwargs) -> requests.Response:
+    """GET the url within its host's concurrency and rate limits
+
+    Rate limited (429) responses are retried after the wait the site asks
+    for. The last response is returned when the retries run out.
+    Connection errors and 5xx responses are retried by the session itself.
+    """
+    host = urlsplit(url).netloc
+    bucket = bucket_for(url)
+    session = get_session()
+    kwargs.setdefault(
+        "timeout", (settings.connect_timeout, settings.read_timeout)
+    )
+
+    for _ in range(settings.rate_limit_retries + 1):
+        metrics.RATE_LIMIT_WAIT.inc(bucket.acquire(), host=host)
+        with host_slot(url), metrics.REQUEST_SECONDS.time(host=host):
+            response = session.get(_route(url), **kwargs)
+        metrics.REQUESTS.inc(host=host, status=response.status_code)
+        metrics.RESPONSE_BYTES.inc(len(response.content), host=host)
+
+        if response.status_code != 429:  # too many requests
+            bucket.reward()
+            return response
+
+        metrics.RATE_LIMITED.inc(host=host)
+        delay = bucket.penalize(_retry_after(response))
+        fte_print(
+            f"Rate limited: {url}. Waiting {delay:.0f}s", settings.verbosity
+        )
+
+    return response
+
+
+def get(url: str, fresh_ok: bool = False, **kwargs) -> requests.Response:
+    """GET the url, going through the on disk cache when it is enabled
+
+    Cached pages are revalidated with the site (ETag / Last-Modified), and
+    unchanged ones are served from disk. With fresh_ok, pages cached less
+    than the cache's ttl ago are used without asking the site at all.
+    """
+    with metrics.STAGE_SECONDS.time(stage="fetch"):
+        return _get(url, fresh_ok, **kwargs)
+
+
+def _get(url: str, fresh_ok: bool, **kwargs) -> requests.Response:
+    cache = get_cache()
+    if cache is None:
+        return _fetch(url, **kwargs)
+
+    host = urlsplit(url).netloc
+    meta = cache.lookup(url)
+    if meta is not None:
+        if fresh_ok and cache.is_fresh(meta):
+            cached = cache.load(url, meta)
+            if cached is not None:
+                metrics.CACHE_LOOKUPS.inc(host=host, result="fresh")
+                return cached
+
+        kwargs["headers"] = {
+            **kwargs.get("headers", {}),
+            **cache.validators(meta),
+        }
+
+    response = _fetch(url, **kwargs)
+
+    if response.status_code == 304 and meta is not None:  # not modified
+        cached = cache.load(url, meta)
+        if cached is not None:
+            cache.refresh(url, meta)
+            metrics.CACHE_LOOKUPS.inc(host=host, result="revalidated")
+            return cached
+
+        # The cached copy vanished (evicted meanwhile). Ask for it again
+        kwargs["headers"] = {
+            name: value
+            for name, value in kwargs["headers"].items()
+            if name not in ("If-None-Match", "If-Modified-Since")
+        }
+        response = _fetch(url, **kwargs)
+
+    metrics.CACHE_LOOKUPS.inc(host=host, result="miss")
+    if response.status_code == 200:
+        cache.store(url, response)
+
+    return response
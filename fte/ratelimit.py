@@ -0,0 +1,94 @@
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import settings
+
+
+class TokenBucket:
+    """Per host request budget that slows down on 429s and speeds back up
+
+    Tokens refill at rate per second, up to burst. Each rate limited
+    response halves the rate and pauses the host for the Retry-After the
+    site asked for (or an exponential backoff), with jitter so waiting
+    threads don't all retry at once. Every run of successes afterwards
+    raises the rate again, up to where it started.
+    """
+
+    def __init__(self, rate: float, burst: float = 1) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._failures = 0
+        self._successes = 0
+        self._lock = Lock()
+
+    def acquire(self) -> float:
+        """Wait for a token. Return how many seconds were spent waiting"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+
+                delay = self._paused_until - now
+                if delay <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = max(delay, (1 - self._tokens) / self.rate)
+
+            sleep(delay)
+            waited += delay
+
+    def penalize(self, retry_after: Optional[float] = None) -> float:
+        """Back off after a rate limited response. Return the pause length"""
+        with self._lock:
+            self._failures += 1
+            self._successes = 0
+            self.rate = max(settings.min_rate, self.rate / 2)
+
+            if retry_after is None:
+                retry_after = min(
+                    settings.max_backoff,
+                    settings.base_backoff * 2 ** (self._failures - 1),
+                )
+            delay = retry_after + uniform(0, settings.backoff_jitter)
+
+            self._tokens = 0
+            self._paused_until = max(self._paused_until, monotonic() + delay)
+            return delay
+
+    def reward(self) -> None:
+        """Count a successful response, speeding up after enough of them"""
+        with self._lock:
+            self._failures = 0
+            self._successes += 1
+            if self._successes >= settings.rate_recovery:
+                self._successes = 0
+                self.rate = min(self.max_rate, self.rate * 2)
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = Lock()
+
+
+def bucket_for(url: str) -> TokenBucket:
+    """Return the token bucket shared by every request to url's host"""
+    host = urlparse(url).netloc
+
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(
+                settings.host_rates.get(host, settings.default_host_rate)
+            )
+
+        return _buckets[host]
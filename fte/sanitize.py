@@ -0,0 +1,136 @@
+import re
+
+import metrics
+import settings
+from utility import CHAPTER, fte_print, parse_fragment
+
+from bs4.element import Comment, Declaration, Doctype, NavigableString
+from bs4.element import ProcessingInstruction
+
+# Markup that isn't content. Dropped wherever it is
+DROPPED_STRINGS = (Comment, Declaration, Doctype, ProcessingInstruction)
+
+# Removed along with everything inside them
+DROPPED_TAGS = set(
+    "audio button canvas embed form iframe input link meta noscript object "
+    "script select style svg template textarea video".split()
+)
+# Elements with these classes are dropped too. archiveofourown's "landmark"
+# headings ("Chapter Text", ...) are only there for screen readers
+DROPPED_CLASSES = {"landmark"}
+
+# Kept, with only their allowed attributes. Other tags (XenForo's wrappers,
+# spans, ...) are replaced by their contents
+ALLOWED_TAGS = set(
+    "a abbr b big blockquote br caption cite code dd del div dl dt em "
+    "figcaption figure h1 h2 h3 h4 h5 h6 hr i img ins li ol p pre q s small "
+    "strike strong sub sup table tbody td tfoot th thead tr u ul".split()
+)
+GLOBAL_ATTRIBUTES = {"dir", "lang", "title"}
+ALLOWED_ATTRIBUTES = {
+    "a": {"href"},
+    "blockquote": {"cite"},
+    "img": {"alt", "height", "src", "width"},
+    "li": {"value"},
+    "ol": {"start", "type"},
+    "q": {"cite"},
+    "td": {"colspan", "rowspan"},
+    "th": {"colspan", "rowspan"},
+}
+
+# Not \s, which would also collapse the &nbsp;s authors indent with
+WHITESPACE = re.compile(r"[ \t\n\r\f]+")
+KEEP_WHITESPACE = {"pre"}
+
+
+def sanitize_html(html: str) -> str:
+    """Keep only html's allowed tags and attributes, and collapse whitespace
+
+    Lazy loaded images get their real url back in src, and placeholders
+    without one are dropped. ids are kept only where the html links to
+    them.
+    """
+    page = parse_fragment(html)
+
+    linked_ids = {
+        a["href"][1:]
+        for a in page.find_all("a", href=True)
+        if a["href"].startswith("#")
+    }
+
+    for node in [
+        child
+        for child in page.descendants
+        if isinstance(child, DROPPED_STRINGS)
+    ]:
+        node.extract()
+
+    for tag in page.find_all(True):
+        if tag.decomposed:  # inside a tag dropped before it
+            continue
+        classes = tag.get("class", [])
+        if tag.name in DROPPED_TAGS or not DROPPED_CLASSES.isdisjoint(classes):
+            tag.decompose()
+            continue
+
+        if tag.name == "img":
+            src = tag.get("src", "")
+            if not src or src.startswith("data:"):
+                src = tag.get("data-src") or tag.get("data-url")
+            if not src:
+                tag.decompose()
+                continue
+            tag["src"] = src
+
+        if tag.name not in ALLOWED_TAGS:
+            tag.unwrap()
+            continue
+
+        allowed = GLOBAL_ATTRIBUTES | ALLOWED_ATTRIBUTES.get(tag.name, set())
+        if tag.get("id") in linked_ids:
+            allowed = allowed | {"id"}
+        tag.attrs = {
+            name: value for name, value in tag.attrs.items() if name in allowed
+        }
+        if tag.get("href", "").lower().startswith("javascript:"):
+            del tag["href"]
+
+    # Joins the strings left side by side by removed tags, so the space
+    # between them collapses too
+    page.smooth()
+    for text in page.find_all(string=True):
+        if type(text) is not NavigableString:
+            continue
+        if any(parent.name in KEEP_WHITESPACE for parent in text.parents):
+            continue
+        collapsed = WHITESPACE.sub(" ", text)
+        if collapsed != text:
+            text.replace_with(collapsed)
+
+    return str(page).strip()
+
+
+def sanitize_chapters(chapters: CHAPTER, title: str) -> CHAPTER:
+    """Sanitize each chapter as it passes. Report the bytes saved at the end
+
+    See sanitize_html. The html's size before and after is also recorded
+    in metrics.HTML_BYTES.
+    """
+    scraped = sanitized = 0
+    for name, content in chapters:
+        html = str(content)
+        with metrics.STAGE_SECONDS.time(stage="sanitize"):
+            clean = sanitize_html(html)
+
+        scraped += len(html.encode("utf-8"))
+        sanitized += len(clean.encode("utf-8"))
+        yield name, clean
+
+    metrics.HTML_BYTES.inc(scraped, state="scraped")
+    metrics.HTML_BYTES.inc(sanitized, state="sanitized")
+    saved = 100 * (1 - sanitized / scraped) if scraped else 0
+    fte_print(
+        f"Sanitized {title}: {scraped / 1024:.0f} KB of chapter html became "
+        f"{sanitized / 1024:.0f} KB ({saved:.0f}% saved)",
+        settings.verbosity,
+    )
@@ -1,143 +1,483 @@
 import re
-import requests
-from time import sleep
-from typing import Tuple
+from copy import copy
+from urllib.parse import urljoin
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+import network
 import settings
-from utility import CHAPTER, fte_print
-from webdriver import get_webdriver
+from utility import CHAPTER, CHAPTER_DATA, CHAPTER_REFS, KNOWN_CHAPTERS
+from utility import ON_CHAPTER, STORY_INDEX, fte_print, parse_fragment
+from utility import parse_html
+from workers import ordered_imap, run_parser
+
+from bs4 import BeautifulSoup, Comment, SoupStrainer
+from bs4.element import PageElement, Tag
+
+# Only the parts of each page that are read get parsed. The rest is skipped
+# The work's chapter selector and its text (title, summary, notes, chapters)
+AO3_WORK_ONLY = SoupStrainer(id=["selected_id", "workskin"])
+SB_POSTS_ONLY = SoupStrainer("article", id=re.compile(r"^js-post-"))
+# The title, threadmarks button, and summary of a thread's first page
+SB_THREAD_ONLY = SoupStrainer(
+    class_=[
+        "p-title-value",
+        "button--link menuTrigger button",
+        "threadmarkListingHeader-extraInfoChild message-body",
+    ]
+)
+# The author, threadmark links, and threadmark count of the listing
+SB_THREADMARKS_ONLY = SoupStrainer(
+    class_=[
+        "username",
+        "block-body block-body--collapsible block-body--threadmarkBody is-active",  # noqa
+        "dataList-cell dataList-cell--min",
+    ]
+)
+
+
+def _drop_comments(node: PageElement) -> PageElement:
+    """Remove the comments inside node, as it is moved. Return node"""
+    if isinstance(node, Tag):
+        for comment in [
+            child for child in node.descendants if isinstance(child, Comment)
+        ]:
+            comment.extract()
+    return node
+
+
+def _archiveofourown_build_chapter(
+    notes: Optional[Tag], body: Iterable
+) -> Tag:
+    """Join a chapter's notes and body into one comment free Tag
+
+    The body's nodes are moved out of the page, not copied, so the page
+    must not be used for anything else afterwards.
+    """
+    chapter_content = parse_html("")
+
+    # some chapters do not have a notes section. In that case, skip
+    # The notes are copied, since the body may contain them too
+    if notes is not None:
+        for tag in notes:
+            if not isinstance(tag, Comment):
+                chapter_content.append(_drop_comments(copy(tag)))
+    chapter_content.append("\n")
+    chapter_content.append(chapter_content.new_tag("br"))
+    chapter_content.append("\n")
+    for tag in list(body):
+        if not isinstance(tag, Comment):
+            chapter_content.append(_drop_comments(tag))
+
+    return chapter_content
+
+
+def _archiveofourown_parse_chapter(chapter_text: str) -> Tuple[str, str]:
+    """Extract one chapter page's chapter. Runs in the parsing processes"""
+    chapter_parser = parse_html(chapter_text, AO3_WORK_ONLY)
+
+    selected = chapter_parser.find(id="selected_id").find(
+        "option", selected=True
+    )
+    chapter_name = selected.get_text()
+
+    chapter_content = _archiveofourown_build_chapter(
+        chapter_parser.find(class_="notes module"),
+        chapter_parser.find("div", id="chapters"),
+    )
 
-from bs4 import BeautifulSoup, Comment
-from bs4.element import Tag
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
+    return (chapter_name, str(chapter_content))
 
 
-def _archiveofourown_get_chapter(chapter_url: str) -> Tuple[str, Tag]:
+def _archiveofourown_get_chapter(chapter_url: str) -> Tuple[str, str]:
     """Scrape the data for one chapter in archiveofourown. Return it"""
-    sleep(2)  # archive of our own times out if too many requests occur quickly
-    chapter_html = requests.get(chapter_url)
+    chapter_html = network.get(chapter_url, fresh_ok=True)
 
-    if chapter_html.status_code == 429:  # too many requests
-        sleep(300)  # sleep for 5 minutes
-        chapter_html = requests.get(chapter_url)
-    elif chapter_html.status_code != 200:
+    if chapter_html.status_code != 200:
         msg = f"{chapter_url} unreachable. Code: {chapter_html.status_code}"
         raise Exception(msg)
 
-    chapter_parser = BeautifulSoup(chapter_html.text, "html.parser")
+    chapter_name, chapter_content = run_parser(
+        _archiveofourown_parse_chapter, chapter_html.text
+    )
 
-    chapter_name = [
-        re.match(".*>(.*)</option", str(ch)).group(1)
-        for ch in chapter_parser.find(id="selected_id").children
-        if 'selected="selected"' in str(ch)
-    ][0]
+    fte_print(f"\tFinished: {chapter_name}", settings.verbosity)
+    return (chapter_name, chapter_content)
 
-    chapter = ""
-    try:
-        for tag in chapter_parser.find(class_="notes module"):
-            chapter += str(tag)
-    # some chapters do not have a notes section. In that case, skip
-    except TypeError:
-        pass
-    chapter += "\n<br>\n"
-    for tag in chapter_parser.find("div", id="chapters"):
-        chapter += str(tag)
 
-    chapter_content = BeautifulSoup(chapter, "html.parser")
+def _archiveofourown_parse_full_work(work_text: str) -> List[str]:
+    """Extract every chapter of the full work page. Runs in the parsing
+    processes"""
+    work_parser = parse_html(work_text, SoupStrainer(id="chapters"))
 
-    for tag in chapter_content.find_all(lambda tag: isinstance(tag, Comment)):
-        tag.extract()
+    chapters_div = work_parser.find("div", id="chapters")
+    if chapters_div is None:
+        return []
+
+    return [
+        str(
+            _archiveofourown_build_chapter(
+                chapter_div.find(class_="notes module"), [chapter_div]
+            )
+        )
+        for chapter_div in chapters_div.find_all(
+            "div", id=re.compile(r"chapter-\d+"), recursive=False
+        )
+    ]
 
-    fte_print(f"\tFinished: {chapter_name}", settings.verbosity)
-    return (chapter_name, chapter_content)
 
+def _archiveofourown_get_full_work(
+    work_url: str, chapter_names: List[str]
+) -> Optional[CHAPTER]:
+    """Scrape every chapter from the work's single page view. Return them
 
-def archiveofourown(story_url: str) -> Tuple[str, str, Tag, CHAPTER]:
-    """Scrape archiveofourown for the data to make an ebook. Return it all"""
+    Returns None when the full work page can't be used, so the caller can
+    fall back to fetching the chapters one by one.
+    """
+    work_html = network.get(f"{work_url}?view_full_work=true", fresh_ok=True)
+
+    if work_html.status_code != 200:
+        fte_print(
+            f"Full work unreachable. Code: {work_html.status_code}",
+            settings.verbosity,
+        )
+        return None
+
+    chapter_contents = run_parser(
+        _archiveofourown_parse_full_work, work_html.text
+    )
+
+    if len(chapter_contents) != len(chapter_names):
+        fte_print(
+            f"Full work has {len(chapter_contents)} of {len(chapter_names)} chapters",  # noqa
+            settings.verbosity,
+        )
+        return None
+
+    for chapter_name in chapter_names:
+        fte_print(f"\tFinished: {chapter_name}", settings.verbosity)
+
+    return list(zip(chapter_names, chapter_contents))
+
+
+def archiveofourown_index(story_url: str) -> STORY_INDEX:
+    """Scrape archiveofourown for the story's details and chapter list"""
     AO3_SOURCE = "https://archiveofourown.org"
 
-    base_html = requests.get(story_url)
+    base_html = network.get(story_url)
 
     if base_html.status_code != 200:
         raise Exception(
             f"{AO3_SOURCE} story unreachable. Please try again. Status code: {base_html.status_code}"  # noqa
         )
 
-    base_parser = BeautifulSoup(base_html.text, "html.parser")
+    base_parser = parse_html(base_html.text, AO3_WORK_ONLY)
 
     story_id = re.match(r".+works/(\d+)/.+", story_url).group(1)
-    chapter_ids = [
-        re.match('.*"(\\d+)".*', str(chapter).strip()).group(1)
-        for chapter in base_parser.find(id="selected_id").children
-        if re.match('.*"(\\d+)".*', str(chapter).strip())
+    chapter_refs = [
+        (
+            f"{AO3_SOURCE}/works/{story_id}/chapters/{option['value']}",
+            option.get_text(),
+        )
+        for option in base_parser.find(id="selected_id").find_all("option")
+        if option.get("value", "").isdigit()
     ]
 
     title = base_parser.find(class_="title heading").text.strip()
     author = base_parser.find(class_="byline heading").text.strip()
     summary = base_parser.find(class_="summary module")
 
-    chapters = []
-    for ch_id in chapter_ids:
-        url = f"{AO3_SOURCE}/works/{story_id}/chapters/{ch_id}"
-        fte_print(f"Parsing chapter: {url}", settings.verbosity)
-        chapters.append(_archiveofourown_get_chapter(url))
+    return title, author, summary, chapter_refs
+
+
+def archiveofourown_chapters(
+    chapter_refs: CHAPTER_REFS,
+    known: KNOWN_CHAPTERS = None,
+    on_chapter: ON_CHAPTER = None,
+) -> CHAPTER:
+    """Scrape the chapters not already known. Return all of them, in order
+
+    on_chapter is called with each scraped chapter's url and data as soon
+    as it is available.
+    """
+    known = known or {}
+    on_chapter = on_chapter or (lambda url, chapter: None)
+    missing = [url for url, _ in chapter_refs if url not in known]
+    found = {}
+
+    # A few new chapters are cheaper to get alone than inside the whole work
+    if settings.ao3_full_work and (
+        len(missing) == len(chapter_refs)
+        or len(missing) > settings.ao3_max_single_chapters
+    ):
+        fte_print("Parsing full work", settings.verbosity)
+        work_url = re.match(r"(.+/works/\d+)", chapter_refs[0][0]).group(1)
+        chapters = _archiveofourown_get_full_work(
+            work_url, [name for _, name in chapter_refs]
+        )
+        if chapters is not None:
+            found = {
+                url: chapter
+                for (url, _), chapter in zip(chapter_refs, chapters)
+                if url not in known
+            }
+            for url, chapter in found.items():
+                on_chapter(url, chapter)
+
+    # Parsed while the next chapter downloads
+    single = [url for url in missing if url not in found]
+    fte_print(f"Parsing {len(single)} chapters", settings.verbosity)
+    for url, chapter in zip(
+        single, ordered_imap(_archiveofourown_get_chapter, single)
+    ):
+        found[url] = chapter
+        on_chapter(url, chapter)
+
+    return [
+        known[url] if url in known else found[url] for url, _ in chapter_refs
+    ]
 
-    return title, author, summary, chapters
 
+def _spacebattles_parse_posts(
+    page_text: str, post_ids: Set[str]
+) -> Dict[str, Tuple[str, str]]:
+    """Extract the wanted threadmarked posts of a page, by id. Runs in the
+    parsing processes"""
+    page_parser = parse_html(page_text, SB_POSTS_ONLY)
 
-def _spacebattles_get_chapter(chapter_url: str) -> Tuple[str, Tag]:
-    """Scrape the data for one chapter in spacebattles. Return it"""
-    post_id = re.search(r"#(post.+)", chapter_url).group(1)
+    posts = {}
+    for post in page_parser.find_all("article", id=re.compile(r"^js-post-")):
+        post_id = post["id"].replace("js-", "", 1)
+        if post_id not in post_ids:
+            continue
 
-    chapter_html = requests.get(chapter_url)
+        chapter_name = post.find("span", class_="threadmarkLabel").text
+        chapter_content = post.find("div", class_="bbWrapper")
+        posts[post_id] = (chapter_name, str(chapter_content))
 
-    if chapter_html.status_code != 200:
-        msg = f"{chapter_url} unreachable. Code: {chapter_html.status_code}"
+    page_parser.decompose()
+    return posts
+
+
+def _spacebattles_get_posts(
+    page_url: str, post_ids: Set[str], fresh_ok: bool = False
+) -> Dict[str, Tuple[str, str]]:
+    """Scrape every wanted threadmarked post on one page. Return them by id"""
+    page_html = network.get(page_url, fresh_ok=fresh_ok)
+
+    if page_html.status_code != 200:
+        msg = f"{page_url} unreachable. Code: {page_html.status_code}"
         raise Exception(msg)
 
-    chapter_page_parser = BeautifulSoup(chapter_html.text, "html.parser")
-    chapter_parser = chapter_page_parser.find("article", id=f"js-{post_id}")
+    posts = run_parser(_spacebattles_parse_posts, page_html.text, post_ids)
+
+    for chapter_name, _ in posts.values():
+        fte_print(f"\tFinished: {chapter_name}", settings.verbosity)
+
+    return posts
+
+
+def _spacebattles_get_chapters(
+    thread_url: str,
+    chapter_urls: List[str],
+    known: KNOWN_CHAPTERS,
+    on_chapter: ON_CHAPTER,
+) -> Iterator[CHAPTER_DATA]:
+    """Yield every chapter in order, scraping the unknown ones
+
+    Pages are fetched (and parsed) a few at a time ahead of the chapter
+    being yielded, and only their chapters' html is kept until yielded, so
+    memory stays flat however long the story is.
+    """
+    post_ids = [re.search(r"#(post.+)", url).group(1) for url in chapter_urls]
+    unknown = {
+        post_id
+        for url, post_id in zip(chapter_urls, post_ids)
+        if url not in known
+    }
+
+    # Each batch of chapters shares a page: (page url, fresh_ok, indexes)
+    batches = []
+    if settings.sb_reader_mode:
+        # The reader view lists the threadmarks in order, a page at a time.
+        # A cached reader page may predate new threadmarks. Those are then
+        # missed and fetched (revalidated) from their thread pages
+        size = settings.sb_reader_page_size
+        for start in range(0, len(chapter_urls), size):
+            indexes = range(start, min(start + size, len(chapter_urls)))
+            reader_url = f"{thread_url}reader/page-{start // size + 1}"
+            batches.append((reader_url, True, indexes))
+    else:
+        for index, url in enumerate(chapter_urls):
+            page_url = url.split("#")[0]
+            if batches and batches[-1][0] == page_url:
+                batches[-1][2].append(index)
+            else:
+                batches.append((page_url, False, [index]))
+
+    def get_batch(batch: tuple) -> Dict[str, Tuple[str, str]]:
+        page_url, fresh_ok, indexes = batch
+        wanted = {post_ids[index] for index in indexes} & unknown
+        if not wanted:
+            return {}
+        return _spacebattles_get_posts(page_url, wanted, fresh_ok)
+
+    fte_print(f"Parsing {len(batches)} pages", settings.verbosity)
+    not_yielded = set(unknown)
+    spare = {}  # chapters found on the thread page of an earlier chapter
+    pages = ordered_imap(get_batch, batches)
+    for posts, (_, _, indexes) in zip(pages, batches):
+        for index in indexes:
+            url, post_id = chapter_urls[index], post_ids[index]
+            if url in known:
+                yield known[url]
+                continue
+
+            chapter = posts.pop(post_id, None) or spare.pop(post_id, None)
+            if chapter is None:
+                page_url = url.split("#")[0]
+                fte_print(f"Parsing page: {page_url}", settings.verbosity)
+                found = _spacebattles_get_posts(page_url, not_yielded)
+                chapter = found.pop(post_id, None)
+                if chapter is None:
+                    raise Exception(f"Chapters not found: {post_id}")
+                spare.update(found)
+
+            not_yielded.discard(post_id)
+            on_chapter(url, chapter)
+            yield chapter
+
+
+def _spacebattles_chapter_links(
+    threadmarks_parser: BeautifulSoup,
+) -> Tuple[List[Tag], int]:
+    """Return the threadmark links found and how many the story says exist"""
+    chapter_links = threadmarks_parser.find(
+        class_="block-body block-body--collapsible block-body--threadmarkBody is-active",  # noqa
+    ).find_all(
+        "a",
+        # To avoid duplicate with duplicate link inside the publish date tag
+        string=re.compile(r".*"),
+    )
+
+    total_chapters = int(
+        threadmarks_parser.find(class_="dataList-cell dataList-cell--min").text
+    )
+
+    return chapter_links, total_chapters
 
-    chapter_name = chapter_parser.find("span", class_="threadmarkLabel").text
-    chapter_content = chapter_parser.find("div", class_="bbWrapper")
 
-    fte_print(f"\tFinished: {chapter_name}", settings.verbosity)
-    return (chapter_name, chapter_content)
+def _spacebattles_threadmarks_http(
+    threadmarks_url: str,
+) -> Optional[BeautifulSoup]:
+    """Load the full threadmarks listing over plain HTTP. Return it
+
+    Stories with 100+ chapters hide the middle of the listing behind
+    "threadmark-fetcher" placeholders. Each one names the range it loads,
+    which is fetched and put where the placeholder was. Returns None if
+    any piece of the listing can't be fetched.
+    """
+    threadmarks_html = network.get(threadmarks_url)
+
+    if threadmarks_html.status_code != 200:
+        return None
+
+    threadmarks_parser = parse_html(threadmarks_html.text, SB_THREADMARKS_ONLY)
+
+    for fetcher in threadmarks_parser.find_all(
+        attrs={"data-xf-click": "threadmark-fetcher"}
+    ):
+        if not fetcher.get("data-fetchurl"):
+            return None
+
+        range_url = urljoin(threadmarks_url, fetcher["data-fetchurl"])
+        separator = "&" if "?" in range_url else "?"
+        range_html = network.get(f"{range_url}{separator}_xfResponseType=json")
+
+        if range_html.status_code != 200:
+            return None
+
+        # XenForo answers ajax style requests with the html wrapped in json
+        try:
+            range_items = parse_fragment(range_html.json()["html"]["content"])
+        except (ValueError, KeyError, TypeError):
+            range_parser = parse_html(
+                range_html.text, SoupStrainer(class_="structItem--threadmark")
+            )
+            range_items = range_parser.find_all(
+                class_="structItem--threadmark"
+            )
+
+        fetcher.replace_with(*list(range_items))
+
+    return threadmarks_parser
+
+
+def _spacebattles_threadmarks_webdriver(threadmarks_url: str) -> BeautifulSoup:
+    """Load the full threadmarks listing with a web browser. Return it"""
+    # Selenium is slow to import, and most listings never need a browser
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import NoSuchElementException
+    from webdriver import borrow_webdriver
+
+    with borrow_webdriver() as driver:
+        driver.get(threadmarks_url)
+
+        # Stories with 100+ chapters need a button click to reveal the rest
+        try:
+            driver.find_element(
+                By.XPATH, "//div[@data-xf-click='threadmark-fetcher']"
+            ).click()
+        # Stories with <= 100 chapters lack this button. Exception expected
+        except NoSuchElementException:
+            pass
+
+        threadmarks_html = driver.page_source
 
+    threadmarks_parser = parse_html(threadmarks_html, SB_THREADMARKS_ONLY)
 
-def spacebattles(story_url: str) -> Tuple[str, str, Tag, CHAPTER]:
-    """Scrape spacebattles.com for the data to make an ebook. Return it all"""
+    return threadmarks_parser
+
+
+def _spacebattles_get_threadmarks(threadmarks_url: str) -> BeautifulSoup:
+    """Load the full threadmarks listing, using a browser only if needed"""
+    threadmarks_parser = _spacebattles_threadmarks_http(threadmarks_url)
+
+    if threadmarks_parser is not None:
+        chapter_links, total_chapters = _spacebattles_chapter_links(
+            threadmarks_parser
+        )
+        if len(chapter_links) == total_chapters:
+            return threadmarks_parser
+
+    if not settings.sb_webdriver_fallback:
+        if threadmarks_parser is None:
+            raise Exception(f"{threadmarks_url} threadmarks unreachable")
+        return threadmarks_parser
+
+    fte_print("Threadmarks incomplete. Using web driver", settings.verbosity)
+    return _spacebattles_threadmarks_webdriver(threadmarks_url)
+
+
+def spacebattles_index(story_url: str) -> STORY_INDEX:
+    """Scrape spacebattles.com for the story's details and chapter list"""
     SP_SOURCE = "https://forums.spacebattles.com"
 
-    base_html = requests.get(story_url)
+    base_html = network.get(story_url)
 
     if base_html.status_code != 200:
         raise Exception(
             f"{SP_SOURCE} story unreachable. Status code: {base_html.status_code}"  # noqa
         )
 
-    base_parser = BeautifulSoup(base_html.text, "html.parser")
+    base_parser = parse_html(base_html.text, SB_THREAD_ONLY)
 
     threadmarks_button = base_parser.find(
         class_="button--link menuTrigger button"
     )  # noqa
 
-    driver = get_webdriver()
-    driver.get(SP_SOURCE + threadmarks_button["href"])
-
-    # Stories with 100+ chapters need to click a button to reveal the rest
-    try:
-        driver.find_element(
-            By.XPATH, "//div[@data-xf-click='threadmark-fetcher']"
-        ).click()
-    # Stories with <= 100 chapters don't have this button. Exception expected
-    except NoSuchElementException:
-        pass
-
-    threadmarks_html = driver.page_source
-    threadmarks_parser = BeautifulSoup(threadmarks_html, "html.parser")
-    driver.quit()
+    threadmarks_parser = _spacebattles_get_threadmarks(
+        SP_SOURCE + threadmarks_button["href"]
+    )
 
     title = base_parser.find(class_="p-title-value").text.strip()
     author = threadmarks_parser.find(class_="username").text
@@ -145,28 +485,41 @@ def spacebattles(story_url: str) -> Tuple[str, str, Tag, CHAPTER]:
         class_="threadmarkListingHeader-extraInfoChild message-body"
     )
 
-    chapter_urls = threadmarks_parser.find(
-        class_="block-body block-body--collapsible block-body--threadmarkBody is-active",  # noqa
-    ).find_all(
-        "a",
-        # To avoid duplicate with duplicate link inside the publish date tag
-        string=re.compile(r".*"),
+    chapter_links, total_chapters = _spacebattles_chapter_links(
+        threadmarks_parser
     )
 
-    total_chapters = int(
-        threadmarks_parser.find(class_="dataList-cell dataList-cell--min").text
-    )
-
-    if total_chapters != len(chapter_urls):
+    if total_chapters != len(chapter_links):
         core_msg = "Missing chapters detected\n\tfound"
         raise Exception(
-            f"{core_msg}: {len(chapter_urls)} | total: {total_chapters}"
+            f"{core_msg}: {len(chapter_links)} | total: {total_chapters}"
         )  # noqa
 
-    chapters = []
-    for link in chapter_urls:
-        url = SP_SOURCE + link["href"]
-        fte_print(f"Parsing chapter: {url}", settings.verbosity)
-        chapters.append(_spacebattles_get_chapter(url))
+    chapter_refs = [
+        (SP_SOURCE + link["href"], link.text) for link in chapter_links
+    ]
 
-    return title, author, summary, chapters
+    return title, author, summary, chapter_refs
+
+
+def spacebattles_chapters(
+    chapter_refs: CHAPTER_REFS,
+    known: KNOWN_CHAPTERS = None,
+    on_chapter: ON_CHAPTER = None,
+) -> CHAPTER:
+    """Scrape the chapters not already known. Yield all of them, in order
+
+    on_chapter is called with each scraped chapter's url and data just
+    before it is yielded.
+    """
+    known = known or {}
+    on_chapter = on_chapter or (lambda url, chapter: None)
+    if not chapter_refs:
+        return []
+
+    chapter_urls = [url for url, _ in chapter_refs]
+    thread_url = re.match(r"(.+/threads/[^/]+/)", chapter_urls[0]).group(1)
+    # Fetched concurrently, but yielded in threadmark order
+    return _spacebattles_get_chapters(
+        thread_url, chapter_urls, known, on_chapter
+    )
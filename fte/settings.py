@@ -1,3 +1,147 @@
+import os
+from importlib.util import find_spec
+from os import environ
+
+
+def _parse_host_limits(raw: str, cast: type = int) -> dict:
+    """Turn 'host=limit,host=limit' into a {host: limit} dictionary"""
+    limits = {}
+    for pair in filter(None, raw.split(",")):
+        host, limit = pair.split("=")
+        limits[host.strip()] = cast(limit)
+    return limits
+
+
+def _default_parser() -> str:
+    """The fastest installed parser BeautifulSoup can use"""
+    # Looked up without importing it, which would slow down every start
+    return "lxml" if find_spec("lxml") is not None else "html.parser"
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on every platform
+        return os.cpu_count() or 1
+
+
 def init():
-    global verbosity
+    global verbosity, max_workers, host_concurrency, default_host_concurrency
+    global ao3_full_work, ao3_max_single_chapters
+    global sb_reader_mode, sb_reader_page_size
+    global sb_webdriver_fallback
+    global host_rates, default_host_rate, min_rate, rate_recovery
+    global rate_limit_retries, base_backoff, max_backoff, backoff_jitter
+    global connect_timeout, read_timeout, http_retries, http_retry_backoff
+    global pooled_hosts, cache_dir, cache_max_bytes, cache_ttl
+    global host_overrides
+    global checkpoint_dir, shared_dir, lease_ttl, lease_poll
+    global parser, parse_workers, batch_stories
+    global volume_chapters, volume_bytes
+    global embed_images, image_max_size, image_quality
+    global sanitize, zip_compression_level
     verbosity = False
+
+    # BeautifulSoup's parser: lxml, html.parser, or html5lib (which can't
+    # skip the parts of a page that aren't needed, so is the slowest)
+    parser = environ.get("HTML_PARSER", _default_parser())
+    # Processes that parse downloaded pages, so parsing uses every core
+    # instead of taking turns with the downloads. 1 or less parses in the
+    # downloading threads instead. Each costs ~36MB before parsing, and the
+    # cpu count ignores a container's cpu quota, so only up to 4 by default
+    parse_workers = int(
+        environ.get("PARSE_WORKERS", min(_available_cpus(), 4))
+    )
+
+    # Threads used to fetch chapters at the same time
+    max_workers = int(environ.get("MAX_WORKERS", 8))
+
+    # Stories a batch run builds at the same time. Each site's own limits
+    # still apply across all of them
+    batch_stories = int(environ.get("BATCH_STORIES", 4))
+
+    # Split stories into volumes (ebooks) of at most this many chapters, or
+    # of chapters adding up to at most this many bytes. 0 doesn't split
+    volume_chapters = int(environ.get("VOLUME_CHAPTERS", 0))
+    volume_bytes = int(float(environ.get("VOLUME_MB", 0)) * 1024**2)
+
+    # Download chapters' images into the ebook, instead of linking to them.
+    # With Pillow installed, they're scaled down to fit image_max_size
+    # pixels and recompressed (jpegs at image_quality)
+    embed_images = environ.get("EMBED_IMAGES", "false").lower() == "true"
+    image_max_size = int(environ.get("IMAGE_MAX_SIZE", 1200))
+    image_quality = int(environ.get("IMAGE_QUALITY", 80))
+
+    # Strip chapters down to an allow list of tags and attributes, with
+    # whitespace collapsed, before they're written. See sanitize.py
+    sanitize = environ.get("SANITIZE_HTML", "false").lower() == "true"
+    # How hard ebooks are compressed: 0 (fastest, biggest) to 9 (smallest)
+    zip_compression_level = int(environ.get("ZIP_COMPRESSION_LEVEL", 6))
+
+    # Simultaneous requests allowed per host. Unlisted hosts use the default
+    host_concurrency = {
+        "forums.spacebattles.com": 4,
+        "archiveofourown.org": 1,
+    }
+    host_concurrency.update(
+        _parse_host_limits(environ.get("HOST_CONCURRENCY", ""))
+    )
+    default_host_concurrency = 2
+
+    # Requests per second allowed per host. Unlisted hosts use the default
+    # archive of our own times out if too many requests occur quickly
+    host_rates = {"forums.spacebattles.com": 5.0, "archiveofourown.org": 0.5}
+    host_rates.update(_parse_host_limits(environ.get("HOST_RATES", ""), float))
+    default_host_rate = 2.0
+    min_rate = 0.05  # slowest a host is throttled down to after 429s
+    rate_recovery = 10  # successes in a row before speeding up again
+
+    # Handling of rate limited (429) responses, in seconds
+    rate_limit_retries = 5
+    base_backoff = 30  # used when the site doesn't send a Retry-After
+    max_backoff = 300
+    backoff_jitter = 5
+
+    # Shared HTTP session. Timeouts in seconds
+    connect_timeout = float(environ.get("CONNECT_TIMEOUT", 10))
+    read_timeout = float(environ.get("READ_TIMEOUT", 60))
+    http_retries = 3  # for connection errors and 5xx responses
+    http_retry_backoff = 1  # seconds, doubled on every retry
+    pooled_hosts = 10  # hosts to keep keep-alive connections open to
+
+    # Send a host's requests to another server instead, as host=base_url
+    # (e.g. a local replay server for tests and benchmarks)
+    host_overrides = _parse_host_limits(environ.get("HOST_OVERRIDES", ""), str)
+
+    # On disk page cache. Disabled unless it has a directory
+    cache_dir = environ.get("CACHE_DIR")
+    cache_max_bytes = int(environ.get("CACHE_MAX_MB", 1024)) * 1024**2
+    # Seconds a cached chapter is used without checking if it changed
+    cache_ttl = float(environ.get("CACHE_TTL", 0))
+
+    # Chapters are saved here while a story is scraped, so that a failed
+    # build can be resumed. An empty value disables checkpoints
+    checkpoint_dir = environ.get("CHECKPOINT_DIR", ".fte_checkpoints")
+
+    # Directory shared by every replica, so each story is built only once
+    # and finished ebooks are reused. Disabled unless set
+    shared_dir = environ.get("SHARED_DIR")
+    lease_ttl = 120  # seconds a silent builder keeps its claim on a story
+    lease_poll = 2  # seconds between checks for another replica's ebook
+
+    # Download archiveofourown works with one "Entire Work" page request
+    ao3_full_work = environ.get("AO3_FULL_WORK", "true").lower() == "true"
+    # When updating, up to this many new chapters are fetched one by one
+    ao3_max_single_chapters = 3
+
+    # Download spacebattles threadmarks through the thread's reader pages
+    sb_reader_mode = environ.get("SB_READER_MODE", "true").lower() == "true"
+    sb_reader_page_size = 10  # threadmarks shown on each reader page
+
+    # Open a web browser when the threadmarks can't be listed over HTTP
+    sb_webdriver_fallback = (
+        environ.get("SB_WEBDRIVER_FALLBACK", "true").lower() == "true"
+    )
+
+
+init()
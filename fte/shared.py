@@ -0,0 +1,222 @@
+import os
+import shutil
+import sqlite3
+from hashlib import sha256
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from threading import Event, Thread
+from time import sleep, time
+from typing import BinaryIO, Callable, List, Optional
+from uuid import uuid4
+
+import settings
+from utility import fte_print
+
+
+def _hash(text: str) -> str:
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+class SharedStore:
+    """Build leases and finished ebooks shared by every replica
+
+    Lives in a directory every replica mounts. A SQLite table of leases
+    makes sure only one replica builds a story at a time, while the others
+    wait for its ebook. Finished ebooks are kept by story and chapter set,
+    so a story that gained chapters is built again. Outdated ebooks are
+    deleted once no one has read them for lease_ttl seconds, so the
+    directory doesn't fill up, and no replica loses the ebook it reads.
+    """
+
+    def __init__(self, root: str, lease_ttl: float, poll: float) -> None:
+        self.root = Path(root)
+        self.books = self.root / "books"
+        self.books.mkdir(parents=True, exist_ok=True)
+        self.lease_ttl = lease_ttl
+        self.poll = poll
+
+        with self._connect() as db:
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS leases (
+                    story TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires REAL NOT NULL
+                )"""
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.root / "leases.sqlite3", timeout=60)
+
+    def _acquire(self, story: str, owner: str) -> bool:
+        """Take the story's lease, unless another live owner holds it"""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")  # one writer at a time
+            row = db.execute(
+                "SELECT owner, expires FROM leases WHERE story = ?", (story,)
+            ).fetchone()
+            if row is not None and row[0] != owner and row[1] > time():
+                db.rollback()
+                return False
+
+            db.execute(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                (story, owner, time() + self.lease_ttl),
+            )
+            db.commit()
+            return True
+        finally:
+            db.close()
+
+    def _renew(self, story: str, owner: str) -> None:
+        with self._connect() as db:
+            db.execute(
+                "UPDATE leases SET expires = ? WHERE story = ? AND owner = ?",
+                (time() + self.lease_ttl, story, owner),
+            )
+
+    def _release(self, story: str, owner: str) -> None:
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM leases WHERE story = ? AND owner = ?",
+                (story, owner),
+            )
+
+    def lookup(self, story: str, result: str) -> Optional[Path]:
+        """Return the story's ebook stored under result, if there is one
+
+        Its directory's mtime is its last use, so it isn't pruned as it's
+        being read.
+        """
+        result_dir = self.books / story / result
+        for ebook in result_dir.glob("*.epub"):
+            try:
+                os.utime(result_dir)
+            except OSError:  # pruned meanwhile
+                return None
+            return ebook
+        return None
+
+    def _open(self, story: str, result: str) -> Optional[BinaryIO]:
+        """Open the story's ebook stored under result, if there is one
+
+        Once open, it can be read to the end even if it is pruned.
+        """
+        ebook = self.lookup(story, result)
+        if ebook is None:
+            return None
+        try:
+            return open(ebook, "rb")
+        except FileNotFoundError:  # pruned meanwhile
+            return None
+
+    def _prune(self, story: str) -> None:
+        """Delete the story's outdated ebooks no one read for lease_ttl"""
+        stored = {}
+        for ebook in (self.books / story).glob("*/*.epub"):
+            try:
+                stored[ebook.parent] = ebook.stat().st_mtime
+            except OSError:
+                continue
+        if not stored:
+            return
+
+        latest = max(stored, key=stored.get)
+        for result_dir in stored:
+            try:
+                idle = time() - result_dir.stat().st_mtime
+            except OSError:
+                continue
+            if result_dir != latest and idle > self.lease_ttl:
+                shutil.rmtree(result_dir, ignore_errors=True)
+
+    def _store(
+        self, story: str, result: str, build: Callable[[BinaryIO], str]
+    ) -> Path:
+        """Store the ebook build writes under result. Return the stored file
+
+        build writes the ebook into the file object it is given and returns
+        the ebook's name.
+        """
+        result_dir = self.books / story / result
+        result_dir.mkdir(parents=True, exist_ok=True)
+
+        with NamedTemporaryFile(
+            dir=result_dir, suffix=".tmp", delete=False
+        ) as tmp_file:
+            try:
+                name = build(tmp_file)
+            except BaseException:
+                tmp_file.close()
+                os.unlink(tmp_file.name)
+                raise
+
+        stored = result_dir / name
+        os.replace(tmp_file.name, stored)
+        return stored
+
+    def build_once(
+        self,
+        story_url: str,
+        chapter_urls: List[str],
+        build: Callable[[BinaryIO], str],
+        options: List[str] = None,
+    ) -> BinaryIO:
+        """Return the story's finished ebook, opened, building it if needed
+
+        Whoever holds the story's lease calls build, which writes the ebook
+        into the file object it is given and returns the ebook's name.
+        Everyone else waits until that ebook is stored, or takes over the
+        lease if its owner stops renewing it. options name the settings
+        build uses. Ebooks built with different options are kept apart.
+        """
+        story = _hash("\n".join([story_url] + (options or [])))
+        result = _hash("\n".join([story_url] + chapter_urls))
+        owner = uuid4().hex
+
+        while True:
+            ebook = self._open(story, result)
+            if ebook is not None:
+                fte_print(
+                    f"Reusing shared ebook {ebook.name}", settings.verbosity
+                )
+                self._prune(story)
+                return ebook
+
+            if self._acquire(story, owner):
+                break
+
+            fte_print("Another replica is building it", settings.verbosity)
+            sleep(self.poll)
+
+        stop_renewing = Event()
+        renewer = Thread(
+            target=self._keep_renewing,
+            args=(story, owner, stop_renewing),
+            daemon=True,
+        )
+        renewer.start()
+        try:
+            # It may have been stored while this replica waited for the lease
+            ebook = self._open(story, result)
+            if ebook is None:
+                ebook = open(self._store(story, result, build), "rb")
+            self._prune(story)
+            return ebook
+        finally:
+            stop_renewing.set()
+            renewer.join()
+            self._release(story, owner)
+
+    def _keep_renewing(self, story: str, owner: str, stop: Event) -> None:
+        while not stop.wait(self.lease_ttl / 3):
+            self._renew(story, owner)
+
+
+def get_shared_store() -> Optional[SharedStore]:
+    """Return the store in settings.shared_dir, or None if there isn't one"""
+    if not settings.shared_dir:
+        return None
+    return SharedStore(
+        settings.shared_dir, settings.lease_ttl, settings.lease_poll
+    )
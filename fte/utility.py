@@ -1,11 +1,52 @@
-from typing import List, Tuple
-from bs4.element import Tag
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Tuple, Union
+
+if TYPE_CHECKING:  # bs4 is imported on first use. See parse_html
+    from bs4 import BeautifulSoup, SoupStrainer
+    from bs4.element import Tag
+
+import metrics
+import settings
 
 # The inner most string and Tag are chapter name and chapter html, respectively
 # The html allows the ebook to (mostly) maintain the original formatting
-CHAPTER = List[Tuple[str, Tag]]
+# Scraped chapters arrive with their html already serialized to a string
+CHAPTER_DATA = Tuple[str, Union["Tag", str]]
+
+# Chapters may be produced lazily, in order, as they are scraped
+CHAPTER = Iterable[CHAPTER_DATA]
+
+# Each chapter's url and name, in reading order, as listed by the story's index
+CHAPTER_REFS = List[Tuple[str, str]]
+
+# Chapters already scraped (e.g. by an earlier build), keyed by their url
+KNOWN_CHAPTERS = Dict[str, CHAPTER_DATA]
+
+# Called with a chapter's url and data as soon as that chapter is scraped
+ON_CHAPTER = Callable[[str, CHAPTER_DATA], None]
+
+# Called with how many of a story's chapters are ready, and the total
+PROGRESS = Callable[[int, int], None]
+
+# The story's title, author, summary, and chapter list
+STORY_INDEX = Tuple[str, str, "Tag", CHAPTER_REFS]
 
 
 def fte_print(msg: str, toggle: bool) -> None:
     if toggle:
         print(msg)
+
+
+def parse_html(markup: str, only: "SoupStrainer" = None) -> "BeautifulSoup":
+    """Parse markup with settings.parser. With only, just matching parts"""
+    from bs4 import BeautifulSoup
+
+    with metrics.STAGE_SECONDS.time(stage="parse"):
+        return BeautifulSoup(markup, settings.parser, parse_only=only)
+
+
+def parse_fragment(markup: str) -> "BeautifulSoup":
+    """Parse a piece of html (a chapter, ...) that is not a whole page"""
+    from bs4 import BeautifulSoup
+
+    # Not settings.parser: lxml would wrap the html in <html><body>
+    return BeautifulSoup(markup, "html.parser")
@@ -1,7 +1,12 @@
+import atexit
+from contextlib import contextmanager
 from os import devnull, environ
-from typing import Union
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+from typing import Iterator, List, Tuple, Union
 
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.firefox.options import Options as F_Options
 from selenium.webdriver.chrome.options import Options as C_Options
 from selenium.webdriver.firefox.webdriver import WebDriver as FF_WebDriver
@@ -9,10 +14,15 @@ from selenium.webdriver.chrome.webdriver import WebDriver as C_WebDriver
 from selenium.webdriver.firefox.service import Service as FF_Service
 from selenium.webdriver.chrome.service import Service as C_Service
 
+WEBDRIVER = Union[FF_WebDriver, C_WebDriver]
 
-def get_webdriver(
-    log_dest=devnull, browser="firefox"
-) -> Union[FF_WebDriver, C_WebDriver]:
+# Rough resident memory of one headless browser, and what the app itself needs
+DRIVER_MEMORY = 350 * 1024**2
+APP_MEMORY = 256 * 1024**2
+MAX_POOL_SIZE = 4
+
+
+def get_webdriver(log_dest=devnull, browser="firefox") -> WEBDRIVER:
     """Return a webdriver for webscraping"""
     if "LOG_DEST" in environ:
         log_dest = environ["LOG_DEST"]
@@ -41,3 +51,146 @@ def get_webdriver(
         driver = webdriver.Chrome(service=service, options=options)
 
     return driver
+
+
+def _memory_limit() -> int:
+    """Return the container's memory limit in bytes, or 0 if there is none"""
+    for limit_file in (
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ):
+        try:
+            limit = Path(limit_file).read_text().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            return int(limit)
+
+    return 0
+
+
+def _default_pool_size() -> int:
+    """How many browsers fit in the container's memory limit"""
+    limit = _memory_limit()
+    # Unlimited cgroups report absurdly large numbers. Treat them as no limit
+    if not limit or limit >= 2**60:
+        return 1
+
+    return max(1, min(MAX_POOL_SIZE, (limit - APP_MEMORY) // DRIVER_MEMORY))
+
+
+def _is_alive(driver: WEBDRIVER) -> bool:
+    """Health check. A crashed browser can't report its current url"""
+    try:
+        driver.current_url
+    except WebDriverException:
+        return False
+    return True
+
+
+def _quit(driver: WEBDRIVER) -> None:
+    try:
+        driver.quit()
+    except WebDriverException:
+        pass
+
+
+class WebDriverPool:
+    """Started webdrivers kept around so a scrape can skip the browser launch
+
+    At most size drivers exist at once. A driver is thrown away after
+    max_uses scrapes, when it fails its health check, or when a scrape
+    using it raises a WebDriverException.
+    """
+
+    def __init__(self, size: int, max_uses: int) -> None:
+        self.size = size
+        self.max_uses = max_uses
+        self._slots = BoundedSemaphore(size)
+        self._idle: List[Tuple[WEBDRIVER, int]] = []
+        self._lock = Lock()
+
+    def warm(self, count: int) -> None:
+        """Start drivers until count of them are idle (up to the pool size)"""
+        with self._lock:
+            missing = min(count, self.size) - len(self._idle)
+        for _ in range(missing):
+            driver = get_webdriver()
+            with self._lock:
+                self._idle.append((driver, 0))
+
+    @contextmanager
+    def borrow(self) -> Iterator[WEBDRIVER]:
+        """Lend a healthy driver, waiting if all of them are in use"""
+        with self._slots:
+            driver, uses = self._take()
+            crashed = False
+            try:
+                yield driver
+            except WebDriverException:
+                crashed = True
+                raise
+            finally:
+                self._give_back(driver, uses + 1, crashed)
+
+    def close(self) -> None:
+        """Quit every idle driver"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for driver, _ in idle:
+            _quit(driver)
+
+    def _take(self) -> Tuple[WEBDRIVER, int]:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                driver, uses = self._idle.pop()
+            if _is_alive(driver):
+                return driver, uses
+            _quit(driver)
+
+        return get_webdriver(), 0
+
+    def _give_back(self, driver: WEBDRIVER, uses: int, crashed: bool) -> None:
+        if crashed or uses >= self.max_uses:
+            _quit(driver)
+            return
+
+        try:
+            driver.delete_all_cookies()
+        except WebDriverException:
+            _quit(driver)
+            return
+
+        with self._lock:
+            self._idle.append((driver, uses))
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_webdriver_pool() -> WebDriverPool:
+    """Return the process wide webdriver pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WebDriverPool(
+                int(environ.get("WEBDRIVER_POOL_SIZE", _default_pool_size())),
+                int(environ.get("WEBDRIVER_MAX_USES", 20)),
+            )
+            atexit.register(_pool.close)
+        return _pool
+
+
+def borrow_webdriver():
+    """Borrow a driver from the process wide pool. Use it with 'with'"""
+    return get_webdriver_pool().borrow()
+
+
+def warm_webdrivers() -> None:
+    """Start the pool's drivers ahead of time, as set by WEBDRIVER_POOL_WARM"""
+    count = int(environ.get("WEBDRIVER_POOL_WARM", 0))
+    if count:
+        get_webdriver_pool().warm(count)
@@ -0,0 +1,120 @@
+import multiprocessing
+from collections import deque
+from itertools import islice
+from threading import BoundedSemaphore, Lock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+from typing import TypeVar
+from urllib.parse import urlparse
+
+import metrics
+import settings
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_host_slots: Dict[str, BoundedSemaphore] = {}
+_host_slots_lock = Lock()
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pool_lock = Lock()
+
+
+def host_slot(url: str) -> BoundedSemaphore:
+    """Return the semaphore capping simultaneous requests to url's host"""
+    host = urlparse(url).netloc
+
+    with _host_slots_lock:
+        if host not in _host_slots:
+            limit = settings.host_concurrency.get(
+                host, settings.default_host_concurrency
+            )
+            _host_slots[host] = BoundedSemaphore(max(limit, 1))
+
+        return _host_slots[host]
+
+
+def ordered_map(
+    func: Callable[[T], R], items: Sequence[T], workers: int = None
+) -> List[R]:
+    """Run func over items with a bounded thread pool. Keeps items' order"""
+    if workers is None:
+        workers = settings.max_workers
+
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(items)))
+    try:
+        return list(pool.map(func, items))
+    finally:
+        # On failure, don't keep fetching chapters nobody will use
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def ordered_imap(
+    func: Callable[[T], R], items: Sequence[T], workers: int = None
+) -> Iterator[R]:
+    """Like ordered_map, but yield each result as soon as it is next in order
+
+    Only a window of workers items is in flight or waiting to be consumed,
+    so memory stays flat however many items there are.
+    """
+    if workers is None:
+        workers = settings.max_workers
+
+    if workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(items)))
+    try:
+        remaining = iter(items)
+        in_flight = deque(
+            pool.submit(func, item) for item in islice(remaining, workers)
+        )
+        while in_flight:
+            result = in_flight.popleft().result()
+            for item in islice(remaining, 1):
+                in_flight.append(pool.submit(func, item))
+            yield result
+    finally:
+        # Also reached when the consumer stops early, or fails
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _init_parse_worker(parser: str) -> None:
+    settings.parser = parser
+
+
+def _get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """Return the process pool shared by every build, or None if disabled"""
+    global _parse_pool
+
+    with _parse_pool_lock:
+        if _parse_pool is None and settings.parse_workers > 1:
+            # Spawned, since forking a process full of threads isn't safe
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=settings.parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_parse_worker,
+                initargs=(settings.parser,),
+            )
+
+        return _parse_pool
+
+
+def run_parser(func: Callable[..., R], *args) -> R:
+    """Run func(*args) in the parsing process pool, and return its result
+
+    Without a pool, func runs in the calling thread. func must be a module
+    level function, and its arguments and result picklable.
+    """
+    pool = _get_parse_pool()
+    if pool is None:
+        return func(*args)
+
+    # What the worker process records is lost, so time it from here
+    with metrics.STAGE_SECONDS.time(stage="parse"):
+        return pool.submit(func, *args).result()
@@ -0,0 +1,48 @@
+from pathlib import Path
+from threading import Lock
+
+from fte.batch import _interleave_hosts, read_urls, run_batch
+
+SB = "https://forums.spacebattles.com/threads/"
+AO3 = "https://archiveofourown.org/works/"
+
+
+class TestBatch:
+    def test_read_urls(self, tmp_path: Path) -> None:
+        url_file = tmp_path / "urls.txt"
+        url_file.write_text(f"# to read\n{SB}a.1/\n\n  {AO3}2/  \n{SB}a.1/\n")
+
+        assert read_urls(str(url_file)) == [f"{SB}a.1/", f"{AO3}2/"]
+
+    def test_sites_are_interleaved(self) -> None:
+        urls = [f"{SB}a.1/", f"{SB}b.2/", f"{SB}c.3/", f"{AO3}1/", f"{AO3}2/"]
+
+        assert _interleave_hosts(urls) == [
+            f"{SB}a.1/",
+            f"{AO3}1/",
+            f"{SB}b.2/",
+            f"{AO3}2/",
+            f"{SB}c.3/",
+        ]
+
+    def test_failures_are_isolated(self) -> None:
+        started = []
+        started_lock = Lock()
+
+        def build(url: str, dst_dir: str) -> str:
+            with started_lock:
+                started.append(url)
+            if "bad" in url:
+                raise Exception("story unreachable")
+            return f"{dst_dir}/{url.rsplit('/', 2)[1]}.epub"
+
+        urls = [f"{SB}bad.1/", f"{SB}good.2/", f"{AO3}3/"]
+        results = run_batch(build, urls, stories=1, dst_dir="out")
+
+        # A single story at a time still alternates between the sites
+        assert started == [f"{SB}bad.1/", f"{AO3}3/", f"{SB}good.2/"]
+        assert [(url, ebook, error) for url, ebook, error, _ in results] == [
+            (f"{SB}bad.1/", None, "story unreachable"),
+            (f"{SB}good.2/", "out/good.2.epub", None),
+            (f"{AO3}3/", "out/3.epub", None),
+        ]
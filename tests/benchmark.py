@@ -0,0 +1,222 @@
+"""Benchmarks of fte against the local replay server
+
+Run from the repository's root, e.g.:
+    python -m tests.benchmark --chapters 100 1000 5000 --latency 0.05
+    python -m tests.benchmark --startup --runs 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import monotonic, perf_counter
+from typing import Callable, List, Tuple
+
+from tests.replay import ReplayServer, offline_environ, offline_settings
+from fte.fte import main
+
+# tests/__init__.py puts fte/ on sys.path
+import ratelimit
+import settings
+import workers
+from ebook import stream_epub
+from scraper import archiveofourown_chapters, archiveofourown_index
+from scraper import spacebattles_chapters, spacebattles_index
+
+SITES = {
+    "sb": (
+        ReplayServer.add_spacebattles,
+        spacebattles_index,
+        spacebattles_chapters,
+        "covers/spacebattles.png",
+    ),
+    "ao3": (
+        ReplayServer.add_archiveofourown,
+        archiveofourown_index,
+        archiveofourown_chapters,
+        "covers/archiveofourown.png",
+    ),
+}
+
+# tracemalloc only sees the Python heap, not the process' whole memory
+COLUMNS = (
+    "site",
+    "chapters",
+    "stage",
+    "seconds",
+    "requests",
+    "ch/s",
+    "heap MB",
+)
+STARTUP_COLUMNS = ("startup", "best", "median")
+
+ROOT = Path(__file__).parents[1]
+
+
+def use_server(server: ReplayServer) -> None:
+    """Point fte at server, forgetting the limits of earlier runs"""
+    for name, value in offline_settings(server).items():
+        setattr(settings, name, value)
+    ratelimit._buckets.clear()
+    workers._host_slots.clear()
+
+
+def _measure(func: Callable) -> Tuple[object, float, float]:
+    """Run func. Return its result, seconds taken, and peak heap in MB
+
+    The peak is of the Python heap only (tracemalloc): not the memory of
+    C extensions like lxml, nor of the parsing processes.
+    """
+    tracemalloc.start()
+    start = perf_counter()
+    try:
+        result = func()
+    finally:
+        seconds = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def benchmark_story(
+    server: ReplayServer, site: str, chapters: int, size: int = 2000
+) -> List[tuple]:
+    """Time each stage of building one story, then the whole build
+
+    Return a row per stage, with the columns in COLUMNS.
+    """
+    add_story, get_index, get_chapters, cover = SITES[site]
+    url = add_story(server, chapters, size)
+    rows = []
+
+    def stage(name: str, func: Callable) -> object:
+        requests_before = sum(server.requests.values())
+        result, seconds, peak = _measure(func)
+        requests = sum(server.requests.values()) - requests_before
+        rate = chapters / seconds if seconds else 0.0
+        rows.append((site, chapters, name, seconds, requests, rate, peak))
+        return result
+
+    title, author, summary, chapter_refs = stage(
+        "index", lambda: get_index(url)
+    )
+    scraped = stage("chapters", lambda: list(get_chapters(chapter_refs)))
+    stage(
+        "ebook",
+        lambda: stream_epub(title, author, summary, scraped, cover, BytesIO()),
+    )
+
+    stage("end to end", lambda: main(url, dst_file=BytesIO()))
+    return rows
+
+
+def benchmark_startup(runs: int = 5) -> List[tuple]:
+    """Time a cold CLI's first request, and a cold webapp's boot
+
+    Every run starts a new interpreter, so nothing is imported yet. Return
+    a row per measurement, with the columns in STARTUP_COLUMNS.
+    """
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in ("CACHE_DIR", "SHARED_DIR", "WEBDRIVER_POOL_WARM")
+    }
+    cli, webapp = [], []
+
+    for _ in range(runs):
+        with ReplayServer() as server, TemporaryDirectory() as dst_dir:
+            url = server.add_spacebattles(1)
+            start = monotonic()
+            subprocess.run(
+                [sys.executable, "fte/fte.py", "-u", url, "-d", dst_dir],
+                cwd=ROOT,
+                env={**env, **offline_environ(server)},
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            cli.append(server.first_request_at - start)
+
+        start = monotonic()
+        subprocess.run(
+            [sys.executable, "-c", "import application"],
+            cwd=ROOT,
+            env=env,
+            check=True,
+        )
+        webapp.append(monotonic() - start)
+
+    return [
+        ("cli, to first request", min(cli), median(cli)),
+        ("webapp, to booted", min(webapp), median(webapp)),
+    ]
+
+
+def print_startup_rows(rows: List[tuple]) -> None:
+    print(
+        f"{STARTUP_COLUMNS[0]:<24}{STARTUP_COLUMNS[1]:>9}"
+        f"{STARTUP_COLUMNS[2]:>9}"
+    )
+    for name, best, middle in rows:
+        print(f"{name:<24}{best:>9.3f}{middle:>9.3f}")
+
+
+def print_rows(rows: List[tuple]) -> None:
+    print(
+        f"{COLUMNS[0]:<5}{COLUMNS[1]:>9}  {COLUMNS[2]:<11}{COLUMNS[3]:>9}"
+        f"{COLUMNS[4]:>10}{COLUMNS[5]:>10}{COLUMNS[6]:>9}"
+    )
+    for site, chapters, stage, seconds, requests, rate, peak in rows:
+        print(
+            f"{site:<5}{chapters:>9}  {stage:<11}{seconds:>9.2f}"
+            f"{requests:>10}{rate:>10.0f}{peak:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark fte against a local replay server."
+    )
+    parser.add_argument(
+        "--chapters", type=int, nargs="+", default=[100, 1000, 5000]
+    )
+    parser.add_argument("--sites", nargs="+", default=list(SITES))
+    parser.add_argument(
+        "--size", type=int, default=2000, help="Bytes of text per chapter."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per response."
+    )
+    parser.add_argument(
+        "--rate-limit-every",
+        type=int,
+        default=0,
+        help="Answer every nth request with a 429.",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Instead, time the CLI's first request and the webapp's boot.",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=5, help="With --startup, runs to time."
+    )
+    args = parser.parse_args()
+
+    if args.startup:
+        print_startup_rows(benchmark_startup(args.runs))
+        sys.exit()
+
+    with ReplayServer(args.latency, args.rate_limit_every) as server:
+        use_server(server)
+        rows = []
+        for site in args.sites:
+            for chapters in args.chapters:
+                rows += benchmark_story(server, site, chapters, args.size)
+
+    print_rows(rows)
+    if server.rate_limited:
+        print(f"\n{server.rate_limited} requests were answered with a 429")
@@ -0,0 +1,32 @@
+import os
+
+import requests
+
+from fte.cache import HTTPCache
+
+
+def _response(url: str, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response._content = body
+    response.status_code = 200
+    response.url = url
+    return response
+
+
+class TestHTTPCache:
+    def test_evicts_least_recently_used_below_cap(self, tmp_path):
+        cache = HTTPCache(str(tmp_path), max_bytes=1000)
+        urls = [f"https://example.com/{page}" for page in range(10)]
+        for when, url in enumerate(urls):
+            cache.store(url, _response(url, b"x" * 100))
+            _, meta_path = cache._paths(url)
+            os.utime(meta_path, (when, when))
+
+        # Now over the cap: room is made for more than the new page
+        cache.store("https://example.com/new", _response(url, b"x" * 100))
+
+        assert cache._size <= 1000 * HTTPCache.EVICT_TO
+        assert cache.lookup(urls[0]) is None
+        assert cache.lookup(urls[1]) is None
+        assert cache.lookup(urls[-1]) is not None
+        assert cache.lookup("https://example.com/new") is not None
@@ -0,0 +1,170 @@
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+from ebooklib import epub
+
+from fte.ebook import create_epub, read_known_chapters, stream_epub
+from fte.ebook import stream_volumes, write_ebook
+
+# tests/__init__.py puts fte/ on sys.path
+import settings
+
+COVER = "covers/spacebattles.png"
+URLS = [f"https://example.com/story#post-{i}" for i in range(5)]
+
+
+def _chapters(read=None):
+    """Five small chapters. Their numbers are added to read as they're read"""
+    for i in range(5):
+        if read is not None:
+            read.append(i)
+        html = f"<div><p>Text {i}</p></div>"
+        yield f"Chapter {i}", BeautifulSoup(html, "html.parser").div
+
+
+def _summary():
+    return BeautifulSoup("<p>Summary</p>", "html.parser").p
+
+
+class TestStreamEpub:
+    def test_same_book_as_create_epub(self, tmp_path: Path) -> None:
+        (tmp_path / "created").mkdir()
+        (tmp_path / "streamed").mkdir()
+
+        book, name = create_epub(
+            "Title",
+            "Author",
+            _summary(),
+            list(_chapters()),
+            COVER,
+            chapter_urls=URLS,
+        )
+        write_ebook(book, name, str(tmp_path / "created"))
+        streamed_name = stream_epub(
+            "Title",
+            "Author",
+            _summary(),
+            _chapters(),
+            COVER,
+            str(tmp_path / "streamed"),
+            chapter_urls=URLS,
+        )
+
+        assert streamed_name == name
+        created = epub.read_epub(str(tmp_path / "created" / name))
+        streamed = epub.read_epub(str(tmp_path / "streamed" / name))
+        assert streamed.spine == created.spine
+        assert len(streamed.toc) == len(created.toc)
+        assert [item.file_name for item in streamed.items] == [
+            item.file_name for item in created.items
+        ]
+
+        known = read_known_chapters(str(tmp_path / "streamed" / name))
+        assert list(known) == URLS
+        assert known[URLS[3]][0] == "Chapter 3"
+        assert "Text 3" in known[URLS[3]][1].text
+
+    def test_failed_chapter_leaves_no_ebook(self, tmp_path: Path) -> None:
+        def chapters():
+            yield from list(_chapters())[:2]
+            raise Exception("Chapter unreachable")
+
+        with pytest.raises(Exception, match="Chapter unreachable"):
+            stream_epub(
+                "Title",
+                "Author",
+                _summary(),
+                chapters(),
+                COVER,
+                str(tmp_path),
+            )
+
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestStreamVolumes:
+    def _titles(self, path: Path) -> list:
+        return [title for title, _ in read_known_chapters(str(path)).values()]
+
+    def test_split_by_chapters(self, tmp_path: Path) -> None:
+        names = stream_volumes(
+            "Title",
+            "Author",
+            _summary(),
+            _chapters(),
+            COVER,
+            str(tmp_path),
+            chapter_urls=URLS,
+            max_chapters=2,
+        )
+
+        assert names == [
+            "Title-by-Author-Volume-1.epub",
+            "Title-by-Author-Volume-2.epub",
+            "Title-by-Author-Volume-3.epub",
+        ]
+        assert self._titles(tmp_path / names[1]) == ["Chapter 2", "Chapter 3"]
+        assert self._titles(tmp_path / names[2]) == ["Chapter 4"]
+
+        book = epub.read_epub(str(tmp_path / names[1]))
+        story_id = epub.read_epub(str(tmp_path / names[0])).uid[:-2]
+        assert book.uid == f"{story_id}-2"
+        assert book.title == "Title, Volume 2"
+
+    def test_split_by_bytes(self, tmp_path: Path) -> None:
+        chapter_bytes = len(str(next(_chapters())[1]))
+        names = stream_volumes(
+            "Title",
+            "Author",
+            _summary(),
+            _chapters(),
+            COVER,
+            str(tmp_path),
+            max_bytes=chapter_bytes * 3,
+        )
+
+        assert len(names) == 2
+        assert len(epub.read_epub(str(tmp_path / names[0])).spine) == 5
+
+    def test_volume_written_before_next_chapter(self, tmp_path: Path) -> None:
+        read = []
+        chapters = _chapters(read)
+
+        def watched():
+            for chapter in chapters:
+                yield chapter
+                if len(read) == 2:
+                    # Volume 1 is complete without chapter 2 being asked for
+                    assert list(tmp_path.iterdir()) == [
+                        tmp_path / "Title-by-Author-Volume-1.epub"
+                    ]
+
+        stream_volumes(
+            "Title",
+            "Author",
+            _summary(),
+            watched(),
+            COVER,
+            str(tmp_path),
+            max_chapters=2,
+        )
+        assert len(list(tmp_path.iterdir())) == 3
+
+
+class TestCompression:
+    def test_compression_level(self, monkeypatch, tmp_path: Path) -> None:
+        sizes = []
+        for level in (0, 9):
+            monkeypatch.setattr(settings, "zip_compression_level", level)
+            name = stream_epub(
+                "Title",
+                "Author",
+                _summary(),
+                [("Chapter", "<p>" + "Text " * 2000 + "</p>")],
+                COVER,
+                str(tmp_path),
+            )
+            sizes.append((tmp_path / name).stat().st_size)
+
+        assert sizes[1] < sizes[0]
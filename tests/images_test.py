@@ -0,0 +1,54 @@
+from io import BytesIO
+from threading import Barrier
+from types import SimpleNamespace
+
+import pytest
+
+from tests.replay import IMAGE
+from fte.images import ImageStore, _image_type, _shrink
+
+# tests/__init__.py puts fte/ on sys.path
+import network
+import settings
+
+
+class TestImages:
+    def test_image_type(self) -> None:
+        assert _image_type(IMAGE) == ("image/png", ".png")
+        assert _image_type(b"RIFF\0\0\0\0WEBPVP8 ") == ("image/webp", ".webp")
+        assert _image_type(b"<html>Not found</html>") is None
+
+    def test_shrink(self) -> None:
+        Image = pytest.importorskip("PIL.Image")
+
+        shrunk = _shrink(IMAGE)
+
+        with Image.open(BytesIO(shrunk)) as image:
+            assert image.size == (1200, 900)  # settings.image_max_size
+            assert image.format == "JPEG"
+
+    def test_corrupt_image_is_kept(self) -> None:
+        corrupt = IMAGE[:40]
+
+        assert _shrink(corrupt) == corrupt
+
+    def test_downloads_span_chapters(self, monkeypatch) -> None:
+        monkeypatch.setattr(settings, "max_workers", 4)
+        # Only passes once all three chapters' images are being fetched
+        all_fetching = Barrier(3, timeout=5)
+
+        def get(url: str, **kwargs) -> SimpleNamespace:
+            all_fetching.wait()
+            content = IMAGE + url.encode("utf-8")  # a different image each
+            return SimpleNamespace(status_code=200, content=content)
+
+        monkeypatch.setattr(network, "get", get)
+        chapters = [
+            (f"Chapter {n}", f'<p><img src="/{n}.png"></p>') for n in range(3)
+        ]
+        urls = [f"https://example.com/chapter-{n}" for n in range(3)]
+
+        embedded = list(ImageStore().embed(iter(chapters), urls))
+
+        assert [name for name, _ in embedded] == [n for n, _ in chapters]
+        assert all('src="images/' in html for _, html in embedded)
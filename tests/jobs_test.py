@@ -0,0 +1,66 @@
+from pathlib import Path
+from threading import Event
+from time import sleep
+
+from webapp.jobs import JobManager
+
+
+def _build(url: str, option: str, progress, path: str) -> str:
+    with open(path, "wb") as ebook_file:
+        ebook_file.write(b"ebook")
+    return "story.epub"
+
+
+def _finished(jobs: JobManager, job_id: str):
+    for _ in range(100):
+        job = jobs.get(job_id)
+        if job is None or not job.active:
+            return job
+        sleep(0.01)
+    raise Exception("The job never finished")
+
+
+class TestJobManager:
+    def test_users_share_one_job(self, tmp_path: Path) -> None:
+        started, release = Event(), Event()
+        builds = []
+
+        def build(url: str, option: str, progress, path: str) -> str:
+            builds.append(url)
+            started.set()
+            release.wait(5)
+            return _build(url, option, progress, path)
+
+        jobs = JobManager(build, workers=2, job_dir=str(tmp_path))
+        first = jobs.submit("url", "download")
+        started.wait(5)
+        second = jobs.submit("url", "download")
+        release.set()
+
+        assert second is first
+        job = _finished(jobs, first.id)
+        assert builds == ["url"]
+        # Each user downloads it, not just the first
+        for _ in range(2):
+            assert Path(jobs.get(job.id).path).read_bytes() == b"ebook"
+
+    def test_jobs_expire_without_new_submissions(self, tmp_path: Path) -> None:
+        jobs = JobManager(_build, workers=1, ttl=0.5, job_dir=str(tmp_path))
+        job = _finished(jobs, jobs.submit("url", "download").id)
+        assert job.status == "finished"
+
+        sleep(0.6)
+        assert jobs.get(job.id) is None
+        # The ebook went with it
+        assert list(tmp_path.iterdir()) == []
+
+    def test_failed_build_leaves_no_file(self, tmp_path: Path) -> None:
+        def build(url: str, option: str, progress, path: str) -> str:
+            _build(url, option, progress, path)
+            raise Exception("Chapter unreachable")
+
+        jobs = JobManager(build, workers=1, job_dir=str(tmp_path))
+        job = _finished(jobs, jobs.submit("url", "download").id)
+
+        assert job.status == "failed" and job.path is None
+        assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,31 @@
+from fte.metrics import Counter, Histogram
+
+
+class TestMetrics:
+    def test_counter(self) -> None:
+        counter = Counter("requests_total", "Requests.", ("host", "status"))
+        counter.inc(host="a.org", status=200)
+        counter.inc(2, host="a.org", status=200)
+        counter.inc(host='b"c', status=429)
+
+        assert counter.render() == [
+            "# HELP requests_total Requests.",
+            "# TYPE requests_total counter",
+            'requests_total{host="a.org",status="200"} 3',
+            'requests_total{host="b\\"c",status="429"} 1',
+        ]
+
+    def test_histogram(self) -> None:
+        histogram = Histogram("took", "Seconds.", ("stage",), (0.1, 1))
+        histogram.observe(0.05, stage="parse")
+        histogram.observe(0.5, stage="parse")
+        histogram.observe(3, stage="parse")
+
+        assert histogram.render()[2:] == [
+            'took_bucket{stage="parse",le="0.1"} 1',
+            'took_bucket{stage="parse",le="1"} 2',
+            'took_bucket{stage="parse",le="+Inf"} 3',
+            'took_count{stage="parse"} 3',
+            'took_sum{stage="parse"} 3.55',
+        ]
+        assert histogram.totals() == {("parse",): (3, 3.55)}
@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+from fte import ratelimit
+from fte.network import _retry_after
+from fte.ratelimit import TokenBucket
+
+# tests/__init__.py puts fte/ on sys.path
+import settings
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A fake monotonic clock, which sleeping moves forward"""
+    now = [1000.0]
+
+    def sleep(seconds: float) -> None:
+        now[0] += seconds
+
+    monkeypatch.setattr(ratelimit, "monotonic", lambda: now[0])
+    monkeypatch.setattr(ratelimit, "sleep", sleep)
+    monkeypatch.setattr(ratelimit, "uniform", lambda low, high: high)
+    monkeypatch.setattr(settings, "base_backoff", 30)
+    monkeypatch.setattr(settings, "max_backoff", 100)
+    monkeypatch.setattr(settings, "backoff_jitter", 5)
+    monkeypatch.setattr(settings, "min_rate", 0.5)
+    monkeypatch.setattr(settings, "rate_recovery", 3)
+    return now
+
+
+def _response(retry_after: str = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 429
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return response
+
+
+class TestTokenBucket:
+    def test_tokens_refill_at_rate(self, clock) -> None:
+        bucket = TokenBucket(rate=4, burst=2)
+
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == pytest.approx(0.25)
+
+        clock[0] += 10  # refills up to burst only
+        assert [bucket.acquire() for _ in range(3)] == pytest.approx(
+            [0, 0, 0.25]
+        )
+
+    def test_backoff_doubles_with_jitter(self, clock) -> None:
+        bucket = TokenBucket(rate=4)
+
+        # base_backoff, doubled on every 429 in a row, up to max_backoff
+        delays = [bucket.penalize() for _ in range(4)]
+
+        assert delays == [30 + 5, 60 + 5, 100 + 5, 100 + 5]
+        assert bucket.rate == 0.5  # halved each time, down to min_rate
+
+    def test_retry_after_pauses_the_host(self, clock) -> None:
+        bucket = TokenBucket(rate=4)
+        bucket.acquire()
+
+        assert bucket.penalize(retry_after=7) == 7 + 5
+        assert bucket.rate == 2
+        assert bucket.acquire() == pytest.approx(12)
+
+    def test_successes_restore_the_rate(self, clock) -> None:
+        bucket = TokenBucket(rate=4)
+        bucket.penalize()
+        bucket.penalize()
+        assert bucket.rate == 1
+
+        for _ in range(2):
+            bucket.reward()
+        bucket.penalize()  # the run of successes starts over
+        assert bucket.rate == 0.5
+
+        for _ in range(3 * 4):
+            bucket.reward()
+        assert bucket.rate == 4  # never above where it started
+
+        # The next 429 backs off from base_backoff again
+        assert bucket.penalize() == 30 + 5
+
+
+class TestRetryAfter:
+    def test_seconds(self) -> None:
+        assert _retry_after(_response("120")) == 120
+        assert _retry_after(_response(" 3 ")) == 3
+
+    def test_http_date(self) -> None:
+        later = datetime.now(timezone.utc) + timedelta(seconds=60)
+        retry_after = _retry_after(_response(format_datetime(later, True)))
+        assert 55 < retry_after <= 60
+
+        earlier = datetime.now(timezone.utc) - timedelta(seconds=60)
+        assert _retry_after(_response(format_datetime(earlier, True))) == 0
+
+    def test_missing_or_invalid(self) -> None:
+        assert _retry_after(_response()) is None
+        assert _retry_after(_response("soon")) is None
+        assert _retry_after(_response("-5")) is None
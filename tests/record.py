@@ -0,0 +1,101 @@
+"""Record a story's pages from its site, for the replay server
+
+Every page fte fetches while scraping the story is saved under
+tests/recorded_pages/<host>/, replacing what was recorded from that host
+before. The story is scraped each way fte can read it (archiveofourown's
+full work and single chapters, spacebattles' reader and thread pages),
+so replays work in either mode.
+
+Run from the repository's root, e.g.:
+    python -m tests.record https://archiveofourown.org/works/4321/chapters/9001
+
+Then update tests/replay_test.py's TestRecordedPages to the new story.
+"""
+import argparse
+import json
+import re
+import shutil
+from typing import Dict
+from urllib.parse import parse_qs, urlsplit
+
+from tests.replay import AO3_HOST, RECORDED_PAGES, SB_HOST, page_key
+
+# tests/__init__.py puts fte/ on sys.path
+import network
+import scraper
+import settings
+
+# The settings each way of reading a story needs
+MODES = {
+    AO3_HOST: [{"ao3_full_work": True}, {"ao3_full_work": False}],
+    SB_HOST: [{"sb_reader_mode": True}, {"sb_reader_mode": False}],
+}
+SCRAPERS = {
+    AO3_HOST: (
+        scraper.archiveofourown_index,
+        scraper.archiveofourown_chapters,
+    ),
+    SB_HOST: (scraper.spacebattles_index, scraper.spacebattles_chapters),
+}
+
+
+def page_file(key: str) -> str:
+    """The file a page is saved as, named after its page_key"""
+    return re.sub(r"[^\w.-]+", "_", key).strip("_") + ".html"
+
+
+def record(story_url: str) -> Dict[str, str]:
+    """Scrape the story, saving each page fetched. Return them by key"""
+    host = urlsplit(story_url).netloc
+    get_index, get_chapters = SCRAPERS[host]
+    pages = {}
+
+    def recording_get(url: str, *args, **kwargs):
+        response = get(url, *args, **kwargs)
+        if response.status_code == 200:
+            pieces = urlsplit(url)
+            pages[
+                page_key(pieces.path, parse_qs(pieces.query))
+            ] = response.text
+        return response
+
+    get = network.get
+    network.get = recording_get
+    saved = {name: getattr(settings, name) for name in MODES[host][0]}
+    try:
+        for mode in MODES[host]:
+            for name, value in mode.items():
+                setattr(settings, name, value)
+            *_, chapter_refs = get_index(story_url)
+            list(get_chapters(chapter_refs))
+    finally:
+        network.get = get
+        for name, value in saved.items():
+            setattr(settings, name, value)
+
+    return pages
+
+
+def save(story_url: str, pages: Dict[str, str]) -> None:
+    pieces = urlsplit(story_url)
+    host_dir = RECORDED_PAGES / pieces.netloc
+    shutil.rmtree(host_dir, ignore_errors=True)
+    host_dir.mkdir(parents=True)
+
+    for key, text in pages.items():
+        (host_dir / page_file(key)).write_text(text, encoding="utf-8")
+    manifest = {
+        "story": page_key(pieces.path, parse_qs(pieces.query)),
+        "pages": {key: page_file(key) for key in sorted(pages)},
+    }
+    (host_dir / "pages.json").write_text(json.dumps(manifest, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record a story's pages for the replay server."
+    )
+    parser.add_argument("url", help="The story's url, as given to fte.")
+    args = parser.parse_args()
+
+    save(args.url, record(args.url))
@@ -0,0 +1,420 @@
+import json
+import re
+import struct
+import zlib
+from collections import Counter
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+SB_HOST = "forums.spacebattles.com"
+AO3_HOST = "archiveofourown.org"
+
+SB_THREAD_PAGE_SIZE = 20  # posts per thread page
+SB_READER_PAGE_SIZE = 10  # threadmarks per reader page
+SB_LISTING_HEAD = 50  # threadmarks listed before the fetcher placeholder
+SB_LISTING_TAIL = 10  # and after it
+
+# Pages saved from the sites, by host. See tests/record.py
+RECORDED_PAGES = Path(__file__).parent / "recorded_pages"
+
+PARAGRAPH = "<p>" + "All work and no play makes Jack a dull boy. " * 8 + "</p>"
+
+
+def _paragraphs(chapter_bytes: int) -> str:
+    return PARAGRAPH * max(1, chapter_bytes // len(PARAGRAPH))
+
+
+def _png(width: int, height: int) -> bytes:
+    """A png image of a single color"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        crc = struct.pack(">I", zlib.crc32(kind + data))
+        return struct.pack(">I", len(data)) + kind + data + crc
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    rows = (b"\x00" + b"\x80\x40\x20" * width) * height
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+IMAGE = _png(2000, 1500)
+LAST_MODIFIED = "Thu, 05 May 2022 12:00:00 GMT"
+
+
+def etag(page: Union[str, bytes]) -> str:
+    """The ETag the replay server sends with page"""
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+    return f'"{sha256(page).hexdigest()[:16]}"'
+
+
+class _SpacebattlesStory:
+    """A thread whose posts are all threadmarked chapters
+
+    With images, every post shows a banner, and a signature that is the
+    same image under a different url in each post.
+    """
+
+    def __init__(
+        self, thread_id: int, chapters: int, size: int, images: bool = False
+    ) -> None:
+        self.path = f"/threads/story.{thread_id}/"
+        self.chapters = chapters
+        self.body = _paragraphs(size)
+        self.images = images
+
+    def _post(self, number: int) -> str:
+        images = ""
+        if self.images:
+            images = (
+                f'<img src="{self.path}attachments/banner.png">'
+                f'<img class="bbImage" src="data:image/gif;base64,R0lGOD" '
+                f'data-src="attachments/signature-{number}.png">'
+            )
+        return (
+            f'<article class="message message--post js-post" '
+            f'id="js-post-{number}"><span class="threadmarkLabel">'
+            f'Chapter {number}</span><div class="message-content">'
+            f'<article class="message-body"><div class="bbWrapper">'
+            f"<b>Chapter {number}</b>{self.body}{images}</div></article></div>"
+            f"</article>"
+        )
+
+    def _posts(self, first: int, size: int) -> str:
+        last = min(first + size - 1, self.chapters)
+        return "".join(self._post(n) for n in range(first, last + 1))
+
+    def _links(self, first: int, last: int) -> str:
+        return "".join(
+            f'<li class="structItem--threadmark"><a href="{self.path}page-'
+            f'{(n - 1) // SB_THREAD_PAGE_SIZE + 1}#post-{n}">Chapter {n}</a>'
+            f"<span>May 5</span></li>"
+            for n in range(first, last + 1)
+        )
+
+    def _listing(self) -> str:
+        head_end = min(self.chapters, SB_LISTING_HEAD)
+        links = self._links(1, head_end)
+        tail_start = max(head_end + 1, self.chapters - SB_LISTING_TAIL + 1)
+        if tail_start > head_end + 1:
+            # Long listings hide the middle behind a "threadmark-fetcher"
+            links += (
+                f'<div data-xf-click="threadmark-fetcher" data-fetchurl="'
+                f"{self.path}threadmarks-load-range?min={head_end + 1}&amp;"
+                f'max={tail_start - 1}">...</div>'
+            )
+        if tail_start <= self.chapters:
+            links += self._links(tail_start, self.chapters)
+
+        return (
+            f'<html><body><div class="p-body-header"><a class="username">'
+            f'Author</a></div><div class="block-body block-body--collapsible'
+            f' block-body--threadmarkBody is-active"><ul>{links}</ul></div>'
+            f'<dl><dd class="dataList-cell dataList-cell--min">'
+            f"{self.chapters}</dd></dl></body></html>"
+        )
+
+    def page(
+        self, path: str, query: Dict[str, list]
+    ) -> Optional[Union[str, bytes]]:
+        if not path.startswith(self.path):
+            return None
+        rest = path[len(self.path):]
+
+        if self.images and re.fullmatch(r"attachments/[\w-]+\.png", rest):
+            return IMAGE
+
+        if rest == "":
+            return (
+                f'<html><body><h1 class="p-title-value">Spacebattles '
+                f"Story</h1>"
+                f'<a class="button--link menuTrigger button" '
+                f'href="{self.path}threadmarks">Threadmarks</a>'
+                f'<div class="threadmarkListingHeader-extraInfoChild '
+                f'message-body"><p>A synthetic story.</p></div>'
+                f"{self._posts(1, SB_THREAD_PAGE_SIZE)}</body></html>"
+            )
+        if rest == "threadmarks":
+            return self._listing()
+        if rest == "threadmarks-load-range":
+            first, last = int(query["min"][0]), int(query["max"][0])
+            return json.dumps({"html": {"content": self._links(first, last)}})
+
+        page = re.fullmatch(r"(reader/)?page-(\d+)", rest)
+        if page is None:
+            return None
+        size = SB_READER_PAGE_SIZE if page.group(1) else SB_THREAD_PAGE_SIZE
+        first = (int(page.group(2)) - 1) * size + 1
+        if first > self.chapters:
+            return None
+        return f"<html><body>{self._posts(first, size)}</body></html>"
+
+
+class _ArchiveOfOurOwnStory:
+    """A multi chapter work, with its "Entire Work" view"""
+
+    def __init__(self, work_id: int, chapters: int, size: int) -> None:
+        self.path = f"/works/{work_id}"
+        self.chapters = chapters
+        self.body = _paragraphs(size)
+
+    def chapter_id(self, number: int) -> int:
+        return 1000 + number
+
+    def _chapter(self, number: int) -> str:
+        return (
+            f'<div class="chapter" id="chapter-{number}"><div class="chapter'
+            f' preface group"><h3 class="title">Chapter {number}</h3>'
+            f'<div class="notes module" id="notes"><h3 class="heading">'
+            f"Notes:</h3><p>Notes for chapter {number}</p></div></div>"
+            f'<div class="userstuff module"><!-- chapter text -->'
+            f"{self.body}</div></div>"
+        )
+
+    def _work(self, selected: int, chapters: str) -> str:
+        options = "".join(
+            f'<option {"selected " if n == selected else ""}'
+            f'value="{self.chapter_id(n)}">{n}. Chapter {n}</option>'
+            for n in range(1, self.chapters + 1)
+        )
+        return (
+            f'<html><body><ul class="work navigation"><li>'
+            f'<select id="selected_id" name="selected_id">{options}</select>'
+            f'</li></ul><div id="workskin"><div class="preface group">'
+            f'<h2 class="title heading">Archive Story</h2>'
+            f'<h3 class="byline heading"><a rel="author">Author</a></h3>'
+            f'<div class="summary module"><p>A synthetic work.</p></div>'
+            f'</div><div id="chapters">{chapters}</div></div></body></html>'
+        )
+
+    def page(self, path: str, query: Dict[str, list]) -> Optional[str]:
+        if path == self.path and query.get("view_full_work") == ["true"]:
+            numbers = range(1, self.chapters + 1)
+            return self._work(1, "".join(self._chapter(n) for n in numbers))
+
+        chapter = re.fullmatch(rf"{self.path}/chapters/(\d+)", path)
+        if chapter is None:
+            return None
+        number = int(chapter.group(1)) - self.chapter_id(0)
+        if not 1 <= number <= self.chapters:
+            return None
+        return self._work(number, self._chapter(number))
+
+
+def page_key(path: str, query: Dict[str, list]) -> str:
+    """How a recorded page's path and query are found in pages.json"""
+    if not query:
+        return path
+    return f"{path}?{urlencode(sorted(query.items()), doseq=True)}"
+
+
+class _RecordedStory:
+    """A story whose pages were saved from the site. See tests/record.py
+
+    pages.json names the story's path, and the file of each page by its
+    page_key.
+    """
+
+    def __init__(self, host: str) -> None:
+        self.dir = RECORDED_PAGES / host
+        manifest = json.loads((self.dir / "pages.json").read_text())
+        self.path = manifest["story"]
+        self.pages = manifest["pages"]
+
+    def page(self, path: str, query: Dict[str, list]) -> Optional[str]:
+        name = self.pages.get(page_key(path, query))
+        if name is None:
+            return None
+        return (self.dir / name).read_text(encoding="utf-8")
+
+
+class ReplayServer:
+    """A local stand-in for spacebattles and archiveofourown
+
+    Serves synthetic stories, of any length, with the markup the scrapers
+    read, and each site's recorded story. settings.host_overrides (see
+    overrides) sends the scrapers here. Every response can be delayed by
+    latency seconds, and every nth request (rate_limit_every) answered
+    with a 429. fail makes a page answer with an error status for a
+    while. Pages carry an ETag and a Last-Modified, and conditional
+    requests for unchanged pages get a 304.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate_limit_every: int = 0,
+        retry_after: float = 0,
+    ) -> None:
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.requests = Counter()  # by host, 429s included
+        self.paths = Counter()  # by "<host>/<path>", without the query
+        self.not_modified = 0  # 304s answered
+        self.last_headers: Dict[str, dict] = {}  # by path, as in paths
+        self._failures: Dict[str, list] = {}  # path -> [status, times]
+        self.rate_limited = 0
+        self.first_request_at: Optional[float] = None  # time.monotonic()
+        self._stories: Dict[str, list] = {SB_HOST: [], AO3_HOST: []}
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def add_spacebattles(
+        self, chapters: int, size: int = 2000, images: bool = False
+    ) -> str:
+        """Add a spacebattles story of size byte chapters. Return its url"""
+        story = _SpacebattlesStory(
+            len(self._stories[SB_HOST]) + 1, chapters, size, images
+        )
+        self._stories[SB_HOST].append(story)
+        return f"https://{SB_HOST}{story.path}"
+
+    def add_archiveofourown(self, chapters: int, size: int = 2000) -> str:
+        """Add an archiveofourown work of size byte chapters. Return its url"""
+        story = _ArchiveOfOurOwnStory(
+            len(self._stories[AO3_HOST]) + 1, chapters, size
+        )
+        self._stories[AO3_HOST].append(story)
+        return f"https://{AO3_HOST}{story.path}/chapters/{story.chapter_id(1)}"
+
+    def add_recorded(self, host: str) -> str:
+        """Add the story recorded from host. Return its url"""
+        story = _RecordedStory(host)
+        self._stories[host].append(story)
+        return f"https://{host}{story.path}"
+
+    def fail(self, url: str, status: int = 503, times: int = 1) -> None:
+        """Answer the next times requests for url's page with status"""
+        pieces = urlsplit(url)
+        self._failures[f"{pieces.netloc}{pieces.path}"] = [status, times]
+
+    @property
+    def overrides(self) -> Dict[str, str]:
+        """The settings.host_overrides that route both sites here"""
+        host, port = self._server.server_address[:2]
+        return {
+            SB_HOST: f"http://{host}:{port}/{SB_HOST}",
+            AO3_HOST: f"http://{host}:{port}/{AO3_HOST}",
+        }
+
+    def _respond(
+        self, url: str, headers: Dict[str, str]
+    ) -> Tuple[int, Union[str, bytes]]:
+        pieces = urlsplit(url)
+        site, _, path = pieces.path[1:].partition("/")
+        query = parse_qs(pieces.query)
+
+        with self._lock:
+            if self.first_request_at is None:
+                self.first_request_at = monotonic()
+            self.requests[site] += 1
+            self.paths[pieces.path[1:]] += 1
+            self.last_headers[pieces.path[1:]] = dict(headers)
+            failure = self._failures.get(pieces.path[1:])
+            if failure is not None and failure[1] > 0:
+                failure[1] -= 1
+                return failure[0], "Failed on purpose"
+            limited = (
+                self.rate_limit_every
+                and sum(self.requests.values()) % self.rate_limit_every == 0
+            )
+            if limited:
+                self.rate_limited += 1
+        if limited:
+            return 429, "Too many requests"
+
+        for story in self._stories.get(site, []):
+            page = story.page(f"/{path}", query)
+            if page is not None:
+                if headers.get("If-None-Match") == etag(page):
+                    with self._lock:
+                        self.not_modified += 1
+                    return 304, b""
+                return 200, page
+        return 404, "Not found"
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                sleep(server.latency)
+                status, body = server._respond(self.path, self.headers)
+                content_type = "image/png"
+                if isinstance(body, str):
+                    content_type = "text/html; charset=utf-8"
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                if status == 200:
+                    self.send_header("ETag", etag(body))
+                    self.send_header("Last-Modified", LAST_MODIFIED)
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", str(server.retry_after))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client timed out while the latency passed
+
+            def log_message(self, *args) -> None:
+                pass  # keep benchmark output readable
+
+        return Handler
+
+    def __enter__(self) -> "ReplayServer":
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def offline_settings(server: ReplayServer) -> Dict[str, object]:
+    """settings values that point fte at server, with no politeness delays
+
+    Also keeps every build self contained: no caches, checkpoints, shared
+    store, browser, or parsing processes.
+    """
+    return {
+        "host_overrides": server.overrides,
+        "host_rates": {SB_HOST: 1000.0, AO3_HOST: 1000.0},
+        "host_concurrency": {SB_HOST: 8, AO3_HOST: 8},
+        "backoff_jitter": 0,
+        "cache_dir": None,
+        "checkpoint_dir": "",
+        "shared_dir": None,
+        "sb_webdriver_fallback": False,
+        "parse_workers": 1,
+    }
+
+
+def offline_environ(server: ReplayServer) -> Dict[str, str]:
+    """The environment variables of offline_settings, for fte subprocesses"""
+    return {
+        "HOST_OVERRIDES": ",".join(
+            f"{host}={base}" for host, base in server.overrides.items()
+        ),
+        "HOST_RATES": f"{SB_HOST}=1000,{AO3_HOST}=1000",
+        "HOST_CONCURRENCY": f"{SB_HOST}=8,{AO3_HOST}=8",
+        "CHECKPOINT_DIR": "",
+        "SB_WEBDRIVER_FALLBACK": "false",
+        "PARSE_WORKERS": "1",
+    }
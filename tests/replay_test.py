@@ -0,0 +1,517 @@
+from pathlib import Path
+from time import monotonic, sleep
+from typing import List
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from tests.replay import AO3_HOST, LAST_MODIFIED, SB_HOST, ReplayServer
+from tests.replay import etag, offline_settings
+from tests import record, replay as replay_module
+from tests.benchmark import COLUMNS, benchmark_story
+from fte.fte import main
+
+# tests/__init__.py puts fte/ on sys.path
+import cache
+import metrics
+import network
+import ratelimit
+import scraper
+import settings
+import workers
+from ebook import read_known_chapters
+from utility import parse_fragment
+from ebooklib import epub
+
+
+@pytest.fixture
+def replay(monkeypatch):
+    """Yield a function starting a replay server that fte is pointed at"""
+    servers = []
+
+    def start(**options) -> ReplayServer:
+        server = ReplayServer(**options).__enter__()
+        servers.append(server)
+        for name, value in offline_settings(server).items():
+            monkeypatch.setattr(settings, name, value)
+        monkeypatch.setattr(ratelimit, "_buckets", {})
+        monkeypatch.setattr(workers, "_host_slots", {})
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__(None, None, None)
+
+
+class TestReplay:
+    def test_spacebattles(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_spacebattles(125)
+
+        ebook = main(url, dst_dir=str(tmp_path))
+
+        chapters = list(read_known_chapters(ebook).values())
+        assert [name for name, _ in chapters] == [
+            f"Chapter {n}" for n in range(1, 126)
+        ]
+        assert "Chapter 125" in chapters[-1][1].text
+        # thread, listing, hidden listing range, and 13 reader pages
+        assert server.requests[SB_HOST] == 16
+
+    def test_threadmark_listing_ranges(self, replay) -> None:
+        server = replay()
+        url = server.add_spacebattles(125)
+
+        listing = scraper._spacebattles_threadmarks_http(f"{url}threadmarks")
+
+        links = listing.find_all(class_="structItem--threadmark")
+        assert len(links) == 125
+        # The fetched range is spliced in as is, not as a nested document
+        assert listing.find(["html", "body"]) is None
+
+    def test_archiveofourown(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_archiveofourown(30)
+
+        ebook = main(url, dst_dir=str(tmp_path))
+
+        chapters = list(read_known_chapters(ebook).values())
+        assert len(chapters) == 30
+        assert chapters[0][0] == "1. Chapter 1"
+        assert "Notes for chapter 30" in chapters[-1][1].text
+        assert server.requests[AO3_HOST] == 2  # first chapter, full work
+
+    def test_parse_processes(
+        self, replay, monkeypatch, tmp_path: Path
+    ) -> None:
+        server = replay()
+        monkeypatch.setattr(settings, "parse_workers", 2)
+        monkeypatch.setattr(workers, "_parse_pool", None)
+        sb_url = server.add_spacebattles(45)
+        ao3_url = server.add_archiveofourown(12)
+
+        try:
+            sb_ebook = main(sb_url, dst_dir=str(tmp_path))
+            ao3_ebook = main(ao3_url, dst_dir=str(tmp_path))
+            pool = workers._parse_pool
+        finally:
+            if workers._parse_pool is not None:
+                workers._parse_pool.shutdown()
+
+        assert pool is not None  # the pages really went to the processes
+        sb_chapters = list(read_known_chapters(sb_ebook).values())
+        assert len(sb_chapters) == 45
+        assert "Chapter 45" in sb_chapters[-1][1].text
+        ao3_chapters = list(read_known_chapters(ao3_ebook).values())
+        assert [name for name, _ in ao3_chapters][-1] == "12. Chapter 12"
+        assert "Notes for chapter 12" in ao3_chapters[-1][1].text
+
+    def test_rate_limited_requests_are_retried(
+        self, replay, tmp_path: Path
+    ) -> None:
+        server = replay(rate_limit_every=4)
+        url = server.add_spacebattles(60)
+
+        ebook = main(url, dst_dir=str(tmp_path))
+
+        assert len(read_known_chapters(ebook)) == 60
+        assert server.rate_limited > 0
+        assert server.requests[SB_HOST] == 8 + server.rate_limited
+
+    def test_failed_build_resumes(
+        self, replay, monkeypatch, tmp_path: Path
+    ) -> None:
+        server = replay()
+        checkpoints = tmp_path / "checkpoints"
+        monkeypatch.setattr(settings, "checkpoint_dir", str(checkpoints))
+        url = server.add_spacebattles(50)
+        reader = f"{SB_HOST}{urlsplit(url).path}reader/page-"
+        server.fail(f"https://{reader}3", status=404)
+
+        with pytest.raises(Exception, match="unreachable"):
+            main(url, dst_dir=str(tmp_path))
+        # Chapters 1-20 came before the failed page
+        assert len(list(checkpoints.glob("*/*.json"))) == 20
+
+        server.paths.clear()
+        ebook = main(url, dst_dir=str(tmp_path))
+
+        chapters = list(read_known_chapters(ebook).values())
+        assert [name for name, _ in chapters] == [
+            f"Chapter {n}" for n in range(1, 51)
+        ]
+        assert "Chapter 7" in chapters[6][1].text
+        # Only the pages of the chapters that weren't saved
+        fetched = {path for path in server.paths if path.startswith(reader)}
+        assert fetched == {f"{reader}{page}" for page in (3, 4, 5)}
+        assert not checkpoints.exists()
+
+    def test_benchmark(self, replay) -> None:
+        server = replay()
+
+        rows = benchmark_story(server, "sb", 100)
+
+        assert [row[COLUMNS.index("stage")] for row in rows] == [
+            "index",
+            "chapters",
+            "ebook",
+            "end to end",
+        ]
+        assert rows[-1][COLUMNS.index("requests")] == 13
+
+    def test_metrics(self, replay, tmp_path: Path) -> None:
+        server = replay(rate_limit_every=4)
+        url = server.add_spacebattles(60)
+        metrics.reset()
+
+        main(url, dst_dir=str(tmp_path))
+
+        requests = metrics.REQUESTS.values()
+        assert requests[(SB_HOST, "200")] == 8
+        assert requests[(SB_HOST, "429")] == server.rate_limited
+        assert metrics.RATE_LIMITED.values()[(SB_HOST,)] == server.rate_limited
+        assert metrics.BUILDS.values() == {("finished",): 1}
+        stages = {stage for stage, in metrics.STAGE_SECONDS.totals()}
+        assert stages == {"fetch", "parse", "assemble", "write", "build"}
+
+        rendered = metrics.render()
+        assert f'fte_requests_total{{host="{SB_HOST}",status="200"}} 8' in (
+            rendered
+        )
+        assert metrics.summary().splitlines()[1].startswith(
+            f"{SB_HOST}: {8 + server.rate_limited} requests"
+        )
+
+    def test_volumes(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_spacebattles(25)
+
+        volumes = main(url, dst_dir=str(tmp_path), volume_chapters=10)
+
+        assert [Path(volume).name for volume in volumes] == [
+            f"Spacebattles-Story-by-Author-Volume-{n}.epub" for n in (1, 2, 3)
+        ]
+        assert len(read_known_chapters(volumes[2])) == 5
+
+        requests = server.requests[SB_HOST]
+        resplit = main(
+            url, dst_dir=str(tmp_path), update=True, volume_chapters=20
+        )
+
+        assert resplit == volumes[:2]
+        assert not Path(volumes[2]).exists()
+        assert len(read_known_chapters(resplit[1])) == 5
+        # Every chapter was reused from the old volumes
+        assert server.requests[SB_HOST] == requests + 2
+
+        whole = main(
+            url, dst_dir=str(tmp_path), update=True, volume_chapters=0
+        )
+        assert [path.name for path in tmp_path.glob("*.epub")] == [
+            Path(whole).name
+        ]
+        assert len(read_known_chapters(whole)) == 25
+
+        volumes = main(url, dst_dir=str(tmp_path), volume_chapters=10)
+        assert sorted(tmp_path.glob("*.epub")) == [
+            Path(volume) for volume in volumes
+        ]
+
+    def test_images(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_spacebattles(30, images=True)
+
+        ebook = main(url, dst_dir=str(tmp_path), images=True)
+
+        book = epub.read_epub(ebook)
+        images = [
+            item for item in book.get_items()
+            if item.file_name.startswith("images/")
+        ]
+        # The banner, and the signature under 30 urls, are the same image
+        assert len(images) == 1
+        last_chapter = str(list(read_known_chapters(ebook).values())[-1][1])
+        assert last_chapter.count(f'src="{images[0].file_name}"') == 2
+        assert "data-src" not in last_chapter
+        # thread, listing, 3 reader pages, the banner, and 30 signatures
+        assert server.requests[SB_HOST] == 5 + 1 + 30
+
+        requests = server.requests[SB_HOST]
+        volumes = main(
+            url,
+            dst_dir=str(tmp_path),
+            update=True,
+            volume_chapters=20,
+            images=True,
+        )
+
+        # Reused from the old ebook, and packaged into both volumes
+        assert server.requests[SB_HOST] == requests + 2
+        for volume in volumes:
+            assert [
+                item.file_name for item in epub.read_epub(volume).get_items()
+                if item.file_name.startswith("images/")
+            ] == [images[0].file_name]
+
+        # Updated without --images, the reused chapters keep their images
+        ebook = main(url, dst_dir=str(tmp_path), update=True)
+        assert [
+            item.file_name for item in epub.read_epub(ebook).get_items()
+            if item.file_name.startswith("images/")
+        ] == [images[0].file_name]
+
+    def test_sanitize(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_spacebattles(20)
+        metrics.reset()
+
+        ebook = main(url, dst_dir=str(tmp_path), sanitize=True)
+        # A per call option, left out of the settings later calls see
+        assert settings.sanitize is False
+
+        chapters = list(read_known_chapters(ebook).values())
+        assert "Chapter 20" in chapters[-1][1].text
+        assert "bbWrapper" not in str(chapters[-1][1])
+        html = metrics.HTML_BYTES.values()
+        assert 0 < html[("sanitized",)] < html[("scraped",)]
+
+    def test_shared_ebooks_by_options(
+        self, replay, monkeypatch, tmp_path: Path
+    ) -> None:
+        server = replay()
+        monkeypatch.setattr(settings, "shared_dir", str(tmp_path / "shared"))
+        url = server.add_spacebattles(20)
+        (tmp_path / "out").mkdir()
+
+        plain = main(url, dst_dir=str(tmp_path / "out"))
+        assert "bbWrapper" in str(list(read_known_chapters(plain).values()))
+
+        # Stored by the plain build, but not what a sanitizing one asks for
+        sanitized = main(url, dst_dir=str(tmp_path / "out"), sanitize=True)
+        chapters = list(read_known_chapters(sanitized).values())
+        assert "bbWrapper" not in str(chapters)
+
+
+class TestCachedRequests:
+    @pytest.fixture
+    def server(self, replay, monkeypatch, tmp_path: Path) -> ReplayServer:
+        server = replay()
+        monkeypatch.setattr(settings, "cache_dir", str(tmp_path / "cache"))
+        monkeypatch.setattr(settings, "cache_ttl", 0)
+        monkeypatch.setattr(cache, "_cache", None)
+        metrics.reset()
+        return server
+
+    def _lookups(self) -> dict:
+        return {
+            result: count
+            for (_, result), count in metrics.CACHE_LOOKUPS.values().items()
+        }
+
+    def test_unchanged_page_is_revalidated(self, server) -> None:
+        url = server.add_spacebattles(5)
+        path = f"{SB_HOST}{urlsplit(url).path}"
+
+        first = network.get(url)
+        second = network.get(url)
+
+        assert second.status_code == 200
+        assert second.text == first.text
+        assert server.not_modified == 1
+        assert server.last_headers[path]["If-None-Match"] == etag(first.text)
+        assert server.last_headers[path]["If-Modified-Since"] == (
+            LAST_MODIFIED
+        )
+        assert self._lookups() == {"miss": 1, "revalidated": 1}
+
+    def test_fresh_page_skips_the_site(self, server, monkeypatch) -> None:
+        monkeypatch.setattr(settings, "cache_ttl", 60)
+        monkeypatch.setattr(cache, "_cache", None)
+        url = server.add_spacebattles(5)
+        path = f"{SB_HOST}{urlsplit(url).path}"
+
+        network.get(url)
+        fresh = network.get(url, fresh_ok=True)
+
+        assert fresh.status_code == 200
+        assert server.paths[path] == 1
+        # Without fresh_ok, even a fresh page is checked with the site
+        network.get(url)
+        assert server.paths[path] == 2
+        assert self._lookups() == {"miss": 1, "fresh": 1, "revalidated": 1}
+
+    def test_evicted_page_is_fetched_again(self, server) -> None:
+        url = server.add_spacebattles(5)
+        path = f"{SB_HOST}{urlsplit(url).path}"
+        first = network.get(url)
+        body_path, _ = cache.get_cache()._paths(url)
+        body_path.unlink()  # as if evicted after its metadata was read
+
+        again = network.get(url)
+
+        assert again.status_code == 200
+        assert again.text == first.text
+        # The conditional request got a 304, with nothing cached to serve
+        assert server.not_modified == 1
+        assert server.paths[path] == 3
+        assert "If-None-Match" not in server.last_headers[path]
+
+
+class TestRetries:
+    @pytest.fixture
+    def server(self, replay, monkeypatch) -> ReplayServer:
+        server = replay()
+        monkeypatch.setattr(settings, "http_retries", 1)
+        monkeypatch.setattr(settings, "http_retry_backoff", 0.01)
+        # The session is built from the retry settings on first use
+        monkeypatch.setattr(network, "_session", None)
+        return server
+
+    def test_server_error_is_retried(self, server) -> None:
+        url = server.add_spacebattles(5)
+        path = f"{SB_HOST}{urlsplit(url).path}"
+        server.fail(url, 503, times=1)
+
+        response = network.get(url)
+
+        assert response.status_code == 200
+        assert server.paths[path] == 2
+
+    def test_retries_run_out(self, server) -> None:
+        url = server.add_spacebattles(5)
+        path = f"{SB_HOST}{urlsplit(url).path}"
+        server.fail(url, 503, times=3)
+
+        response = network.get(url)
+
+        assert response.status_code == 503
+        assert server.paths[path] == 2
+
+    def test_stalled_page_times_out(self, server, monkeypatch) -> None:
+        url = server.add_spacebattles(5)
+        path = f"{SB_HOST}{urlsplit(url).path}"
+        monkeypatch.setattr(settings, "read_timeout", 0.1)
+        server.latency = 0.5
+
+        started = monotonic()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            network.get(url)
+
+        assert monotonic() - started < server.latency
+        # The server only counts a request once its latency has passed
+        for _ in range(100):
+            if server.paths[path] >= 2:
+                break
+            sleep(0.01)
+        assert server.paths[path] == 2
+
+
+def _chapter_text(html: str) -> List[str]:
+    """The paragraphs of an archiveofourown chapter's text"""
+    text = parse_fragment(html).find(class_="userstuff module")
+    return [paragraph.get_text() for paragraph in text.find_all("p")]
+
+
+class TestRecordedPages:
+    """The stories in tests/recorded_pages, in the sites' own markup
+
+    The pages there were written by hand after the sites' markup, and are
+    meant to be replaced by real ones recorded with tests/record.py.
+    """
+
+    def test_archiveofourown(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_recorded(AO3_HOST)
+
+        ebook = main(url, dst_dir=str(tmp_path))
+
+        assert server.requests[AO3_HOST] == 2  # first chapter, full work
+        title, author, summary, _ = scraper.archiveofourown_index(url)
+        assert (title, author) == ("The Lighthouse Keeper", "fixture_author")
+        assert "a very long winter" in summary.text
+        chapters = list(read_known_chapters(ebook).values())
+        assert [name for name, _ in chapters] == [
+            "1. Arrival",
+            "2. The Lamp Room",
+            "3. Fog",
+        ]
+        assert "Written for the winter prompt." in chapters[0][1].text
+        assert "not been lit in eleven days" in chapters[0][1].text
+        assert "Thank you all for reading!" in chapters[2][1].text
+
+    def test_archiveofourown_chapter_pages(self, replay, monkeypatch) -> None:
+        server = replay()
+        url = server.add_recorded(AO3_HOST)
+        *_, chapter_refs = scraper.archiveofourown_index(url)
+
+        full_work = scraper.archiveofourown_chapters(chapter_refs)
+        monkeypatch.setattr(settings, "ao3_full_work", False)
+        single = scraper.archiveofourown_chapters(chapter_refs)
+
+        # Both views give the same chapters, just named differently
+        assert [name for name, _ in single] == [
+            "1. Arrival",
+            "2. The Lamp Room",
+            "3. Fog",
+        ]
+        for (_, work_html), (_, chapter_html) in zip(full_work, single):
+            assert _chapter_text(work_html) == _chapter_text(chapter_html)
+            assert "<!--" not in chapter_html
+
+    def test_spacebattles(self, replay, tmp_path: Path) -> None:
+        server = replay()
+        url = server.add_recorded(SB_HOST)
+
+        ebook = main(url, dst_dir=str(tmp_path))
+
+        # thread, listing and the one reader page
+        assert server.requests[SB_HOST] == 3
+        title, author, summary, _ = scraper.spacebattles_index(url)
+        assert (title, author) == ("The Lighthouse Keeper", "Fixture_Author")
+        assert "a very long winter" in summary.text
+        chapters = list(read_known_chapters(ebook).values())
+        assert [name for name, _ in chapters] == [
+            "Chapter 1: Arrival",
+            "Chapter 2: The Lamp Room",
+            "Chapter 3: Fog",
+        ]
+        assert "Keep the light. Log the ships." in chapters[1][1].text
+
+    def test_spacebattles_thread_pages(self, replay, monkeypatch) -> None:
+        server = replay()
+        url = server.add_recorded(SB_HOST)
+        *_, chapter_refs = scraper.spacebattles_index(url)
+
+        reader = list(scraper.spacebattles_chapters(chapter_refs))
+        monkeypatch.setattr(settings, "sb_reader_mode", False)
+        thread = list(scraper.spacebattles_chapters(chapter_refs))
+
+        # The replies between the chapters are skipped
+        assert thread == reader
+        assert not any("Great start!" in html for _, html in thread)
+
+    @pytest.mark.parametrize("site", [SB_HOST, AO3_HOST])
+    def test_recordings_replay(
+        self, replay, monkeypatch, tmp_path: Path, site: str
+    ) -> None:
+        monkeypatch.setattr(record, "RECORDED_PAGES", tmp_path / "pages")
+        monkeypatch.setattr(
+            replay_module, "RECORDED_PAGES", tmp_path / "pages"
+        )
+        server = replay()
+        if site == SB_HOST:
+            url = server.add_spacebattles(25)
+        else:
+            url = server.add_archiveofourown(5)
+        expected = main(url, dst_dir=str(tmp_path))
+
+        record.save(url, record.record(url))
+        recorded_url = replay().add_recorded(site)
+        (tmp_path / "replayed").mkdir()
+        replayed = main(recorded_url, dst_dir=str(tmp_path / "replayed"))
+
+        assert recorded_url == url
+        assert list(read_known_chapters(replayed)) == list(
+            read_known_chapters(expected)
+        )
@@ -0,0 +1,46 @@
+from fte.sanitize import sanitize_html
+
+
+class TestSanitize:
+    def test_spacebattles_post(self) -> None:
+        html = (
+            '<article class="message-body js-selectToQuote">\n'
+            '  <div class="bbWrapper" data-lb-id="post-1">\n'
+            "    <b>Chapter 1</b><br>\n"
+            '    <span style="color: red">Some</span>   text.\n'
+            '    <img src="data:image/gif;base64,R0lGOD" class="bbImage" '
+            'data-src="https://example.com/a.png" alt="a">\n'
+            "    <script>XF.lazy()</script><!-- post end -->\n"
+            "  </div>\n"
+            "</article>"
+        )
+
+        assert sanitize_html(html) == (
+            "<div> <b>Chapter 1</b><br/> Some text. "
+            '<img alt="a" src="https://example.com/a.png"/> </div>'
+        )
+
+    def test_archiveofourown_chapter(self) -> None:
+        html = (
+            '<div class="userstuff module" role="article">'
+            '<h3 class="landmark heading" id="work">Chapter Text</h3>'
+            '<p>See the <a href="#notes">notes</a>.</p>'
+            '<p id="notes" class="x">Notes&nbsp;&nbsp;here.</p>'
+            "<pre>  kept\n  as is</pre></div>"
+        )
+
+        assert sanitize_html(html) == (
+            '<div><p>See the <a href="#notes">notes</a>.</p>'
+            '<p id="notes">Notes\xa0\xa0here.</p>'
+            "<pre>  kept\n  as is</pre></div>"
+        )
+
+    def test_markup_declarations_are_dropped(self) -> None:
+        html = "<!DOCTYPE html><?php echo 1 ?><p>Kept<!-- dropped --></p>"
+
+        assert sanitize_html(html) == "<p>Kept</p>"
+
+    def test_sanitizing_twice_changes_nothing(self) -> None:
+        html = '<div class="bbWrapper"><p>One  <i>two</i></p>\n</div>'
+
+        assert sanitize_html(sanitize_html(html)) == sanitize_html(html)
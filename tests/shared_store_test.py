@@ -0,0 +1,118 @@
+import os
+from pathlib import Path
+from time import sleep, time
+from multiprocessing import Process
+
+from fte.shared import SharedStore, _hash
+
+
+STORY_URL = "https://archiveofourown.org/works/1/chapters/1"
+CHAPTER_URLS = [f"{STORY_URL[:-1]}{ch_id}" for ch_id in range(1, 4)]
+
+
+def _build_story(
+    root: Path, chapter_urls: list, out: Path, options: list = None
+) -> None:
+    """Ask the store for the story, like one replica of the webapp would"""
+    store = SharedStore(root / "shared", lease_ttl=5, poll=0.05)
+
+    def build(dst_file) -> str:
+        with open(root / "builds.log", "a") as log:
+            log.write(f"{os.getpid()}\n")
+        sleep(0.5)  # a slow scrape, so the other replicas have to wait
+        dst_file.write(f"built by {os.getpid()}".encode("utf-8"))
+        return "story.epub"
+
+    with store.build_once(STORY_URL, chapter_urls, build, options) as ebook:
+        out.write_bytes(ebook.read())
+
+
+class TestSharedStore:
+    def _run_replicas(
+        self, root: Path, count: int, chapter_urls: list, options=None
+    ):
+        outs = [root / f"out_{replica}" for replica in range(count)]
+        replicas = [
+            Process(
+                target=_build_story, args=(root, chapter_urls, out, options)
+            )
+            for out in outs
+        ]
+        for replica in replicas:
+            replica.start()
+        for replica in replicas:
+            replica.join(timeout=30)
+            assert replica.exitcode == 0
+
+        return [out.read_text() for out in outs]
+
+    def _builds(self, root: Path) -> int:
+        return len((root / "builds.log").read_text().split())
+
+    def test_one_build_for_concurrent_replicas(self, tmp_path) -> None:
+        ebooks = self._run_replicas(tmp_path, 4, CHAPTER_URLS)
+
+        assert self._builds(tmp_path) == 1
+        assert len(set(ebooks)) == 1
+
+    def test_new_chapters_build_again(self, tmp_path) -> None:
+        self._run_replicas(tmp_path, 1, CHAPTER_URLS)
+        self._run_replicas(tmp_path, 2, CHAPTER_URLS)
+        assert self._builds(tmp_path) == 1
+
+        self._run_replicas(tmp_path, 2, CHAPTER_URLS + [f"{STORY_URL}0"])
+        assert self._builds(tmp_path) == 2
+
+    def test_other_options_build_again(self, tmp_path) -> None:
+        self._run_replicas(tmp_path, 1, CHAPTER_URLS)
+        self._run_replicas(tmp_path, 2, CHAPTER_URLS, ["images=True"])
+        assert self._builds(tmp_path) == 2
+
+        self._run_replicas(tmp_path, 1, CHAPTER_URLS)
+        self._run_replicas(tmp_path, 1, CHAPTER_URLS, ["images=True"])
+        assert self._builds(tmp_path) == 2
+
+    def test_outdated_ebooks_are_pruned(self, tmp_path) -> None:
+        new_chapters = CHAPTER_URLS + [f"{STORY_URL}0"]
+        self._run_replicas(tmp_path, 1, CHAPTER_URLS)
+        self._run_replicas(tmp_path, 1, new_chapters)
+
+        # Read too recently to be pruned. Another replica may be copying it
+        books = tmp_path / "shared" / "books" / _hash(STORY_URL)
+        assert len(list(books.glob("*/*.epub"))) == 2
+
+        result = _hash("\n".join([STORY_URL] + CHAPTER_URLS))
+        os.utime(books / result, (0, 0))  # unread for ages
+        self._run_replicas(tmp_path, 1, new_chapters)
+        assert [ebook.parent.name for ebook in books.glob("*/*.epub")] == [
+            _hash("\n".join([STORY_URL] + new_chapters))
+        ]
+
+    def test_open_ebook_outlives_pruning(self, tmp_path) -> None:
+        store = SharedStore(tmp_path / "shared", lease_ttl=0, poll=0.05)
+
+        def build(content: bytes):
+            def write(dst_file) -> str:
+                dst_file.write(content)
+                return "story.epub"
+
+            return write
+
+        with store.build_once(STORY_URL, CHAPTER_URLS, build(b"old")) as old:
+            sleep(0.01)
+            new_chapters = CHAPTER_URLS + [f"{STORY_URL}0"]
+            store.build_once(STORY_URL, new_chapters, build(b"new")).close()
+
+            assert not Path(old.name).exists()
+            assert old.read() == b"old"
+
+    def test_expired_lease_is_taken_over(self, tmp_path) -> None:
+        store = SharedStore(tmp_path / "shared", lease_ttl=0.5, poll=0.05)
+        # A replica that took the story's lease and then died
+        assert store._acquire(_hash(STORY_URL), "dead-replica")
+
+        start = time()
+        self._run_replicas(tmp_path, 1, CHAPTER_URLS)
+
+        assert self._builds(tmp_path) == 1
+        assert time() - start < 5
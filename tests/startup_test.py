@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+from tests.benchmark import ROOT, STARTUP_COLUMNS, benchmark_startup
+
+HEAVY_MODULES = ("bs4", "ebooklib", "lxml", "requests", "selenium")
+
+
+def _imported_after(code: str) -> set:
+    """The heavy modules a new interpreter has imported after running code"""
+    check = (
+        f"{code}\n"
+        f"import sys\n"
+        f"print(' '.join(m for m in {HEAVY_MODULES} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", check],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(result.stdout.split())
+
+
+class TestStartup:
+    def test_cli_imports_lazily(self) -> None:
+        # As when fte.py is run as a script: fte/ comes first on sys.path
+        code = "import sys; sys.path.insert(0, 'fte'); import fte"
+        assert _imported_after(code) == set()
+
+    def test_webapp_imports_lazily(self) -> None:
+        assert _imported_after("import application") == set()
+
+    def test_startup_benchmark(self) -> None:
+        rows = benchmark_startup(runs=1)
+
+        assert [row[STARTUP_COLUMNS.index("startup")] for row in rows] == [
+            "cli, to first request",
+            "webapp, to booted",
+        ]
+        assert all(row[STARTUP_COLUMNS.index("best")] > 0 for row in rows)
@@ -0,0 +1,138 @@
+from pathlib import Path
+from typing import List
+
+import pytest
+from selenium.common.exceptions import WebDriverException
+
+from fte import webdriver
+from fte.webdriver import WebDriverPool, _default_pool_size, _memory_limit
+
+
+class FakeDriver:
+    def __init__(self) -> None:
+        self.crashed = False
+        self.quit_called = False
+
+    @property
+    def current_url(self) -> str:
+        if self.crashed:
+            raise WebDriverException("Browser crashed")
+        return "about:blank"
+
+    def delete_all_cookies(self) -> None:
+        if self.crashed:
+            raise WebDriverException("Browser crashed")
+
+    def quit(self) -> None:
+        self.quit_called = True
+
+
+@pytest.fixture
+def started(monkeypatch) -> List[FakeDriver]:
+    """Every driver the pool starts, in order"""
+    drivers = []
+
+    def get_webdriver() -> FakeDriver:
+        drivers.append(FakeDriver())
+        return drivers[-1]
+
+    monkeypatch.setattr(webdriver, "get_webdriver", get_webdriver)
+    return drivers
+
+
+class TestWebDriverPool:
+    def test_driver_is_reused(self, started) -> None:
+        pool = WebDriverPool(1, max_uses=5)
+
+        for _ in range(3):
+            with pool.borrow() as driver:
+                assert driver is started[0]
+
+        assert len(started) == 1
+
+    def test_driver_is_recycled_after_max_uses(self, started) -> None:
+        pool = WebDriverPool(1, max_uses=2)
+
+        for _ in range(5):
+            with pool.borrow():
+                pass
+
+        assert len(started) == 3
+        assert [driver.quit_called for driver in started] == [
+            True,
+            True,
+            False,
+        ]
+
+    def test_dead_driver_is_replaced(self, started) -> None:
+        pool = WebDriverPool(1, max_uses=5)
+        pool.warm(1)
+        started[0].crashed = True
+
+        with pool.borrow() as driver:
+            assert driver is started[1]
+
+        assert started[0].quit_called
+
+    def test_driver_is_dropped_after_a_failed_scrape(self, started) -> None:
+        pool = WebDriverPool(1, max_uses=5)
+
+        with pytest.raises(WebDriverException):
+            with pool.borrow():
+                raise WebDriverException("Page crashed")
+        with pool.borrow() as driver:
+            assert driver is started[1]
+
+        assert started[0].quit_called
+
+    def test_warm_stops_at_the_pool_size(self, started) -> None:
+        pool = WebDriverPool(2, max_uses=5)
+
+        pool.warm(4)
+        pool.warm(2)
+        pool.close()
+
+        assert len(started) == 2
+        assert all(driver.quit_called for driver in started)
+
+
+class TestPoolSize:
+    @pytest.mark.parametrize(
+        "limit, size",
+        [
+            (0, 1),  # no limit found
+            (2**63 - 4096, 1),  # cgroup v1's "unlimited"
+            (512 * 1024**2, 1),
+            (1024 * 1024**2, 2),
+            (2048 * 1024**2, 4),
+            (64 * 1024**3, 4),
+        ],
+    )
+    def test_size_fits_memory_limit(self, monkeypatch, limit, size) -> None:
+        monkeypatch.setattr(webdriver, "_memory_limit", lambda: limit)
+
+        assert _default_pool_size() == size
+
+    @pytest.fixture
+    def cgroup(self, monkeypatch, tmp_path: Path) -> Path:
+        # Read the cgroup files from under tmp_path instead of /
+        monkeypatch.setattr(
+            webdriver, "Path", lambda path: tmp_path / path.lstrip("/")
+        )
+        (tmp_path / "sys/fs/cgroup/memory").mkdir(parents=True)
+        return tmp_path / "sys/fs/cgroup"
+
+    def test_cgroup_v2_limit(self, cgroup) -> None:
+        (cgroup / "memory.max").write_text("1073741824\n")
+
+        assert _memory_limit() == 1024**3
+
+    def test_cgroup_v2_without_limit(self, cgroup) -> None:
+        (cgroup / "memory.max").write_text("max\n")
+
+        assert _memory_limit() == 0
+
+    def test_cgroup_v1_limit(self, cgroup) -> None:
+        (cgroup / "memory/memory.limit_in_bytes").write_text("536870912\n")
+
+        assert _memory_limit() == 512 * 1024**2
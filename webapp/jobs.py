@@ -0,0 +1,130 @@
+from pathlib import Path
+from tempfile import mkdtemp
+from threading import Lock
+from time import time
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+# How a job's story is built: (url, option, progress, path) -> ebook name
+# Downloads are written to path. Other options store the ebook elsewhere
+BUILDER = Callable[[str, str, Callable[[int, int], None], str], str]
+
+
+class Job:
+    """One story build requested through the webapp"""
+
+    def __init__(self, url: str, option: str) -> None:
+        self.id = uuid4().hex
+        self.url = url
+        self.option = option
+        self.status = "queued"  # then running, and finished or failed
+        self.ready = 0
+        self.total = 0
+        self.error = None
+        self.ebook = None  # the ebook's name
+        self.path = None  # and, for downloads, its file until expired
+        self.updated = time()
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def progress(self, ready: int, total: int) -> None:
+        self.ready, self.total = ready, total
+        self.updated = time()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "url": self.url,
+            "option": self.option,
+            "status": self.status,
+            "ready": self.ready,
+            "total": self.total,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Runs story builds in a bounded pool of background workers
+
+    Submitting a url that is already queued or building (with the same
+    option) returns the existing job instead of starting another build.
+    Finished jobs, and their ebooks, are forgotten after ttl seconds, so
+    everyone who joined a job can download its ebook until then. Ebooks
+    wait on disk, in job_dir (a new temporary directory by default).
+    """
+
+    def __init__(
+        self,
+        build: BUILDER,
+        workers: int = 2,
+        max_queued: int = 50,
+        ttl: float = 3600,
+        job_dir: str = None,
+    ) -> None:
+        self.build = build
+        self.job_dir = Path(job_dir or mkdtemp(prefix="fte-jobs-"))
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._jobs: Dict[str, Job] = {}
+        self._active: Dict[Tuple[str, str], Job] = {}
+        self._lock = Lock()
+
+    def submit(self, url: str, option: str) -> Job:
+        """Queue a build, or join the identical one already in flight"""
+        self._expire()
+
+        with self._lock:
+            if (url, option) in self._active:
+                return self._active[(url, option)]
+
+            if len(self._active) >= self.max_queued:
+                raise Exception("Too many ebooks in progress. Try again later")
+
+            job = Job(url, option)
+            self._jobs[job.id] = job
+            self._active[(url, option)] = job
+
+        self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def _run(self, job: Job) -> None:
+        job.status = "running"
+        path = self.job_dir / f"{job.id}.epub"
+        try:
+            job.ebook = self.build(
+                job.url, job.option, job.progress, str(path)
+            )
+            if path.is_file():
+                job.path = str(path)
+            job.status = "finished"
+        except Exception as e:
+            path.unlink(missing_ok=True)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.updated = time()
+            with self._lock:
+                del self._active[(job.url, job.option)]
+
+    def _expire(self) -> None:
+        """Forget finished jobs past their ttl, and their ebooks"""
+        now = time()
+        with self._lock:
+            expired = [
+                job
+                for job in self._jobs.values()
+                if not job.active and now - job.updated > self.ttl
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+                if job.path is not None:
+                    Path(job.path).unlink(missing_ok=True)
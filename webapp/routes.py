@@ -1,27 +1,47 @@
 from os import environ
-from pathlib import Path
-from hashlib import sha256
-from datetime import datetime as dt
-from flask import render_template, redirect, url_for, send_file, flash
+from flask import (
+    Response,
+    abort,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    send_file,
+    url_for,
+)
 
 from webapp import app
 from webapp.forms import StoryURLForm
+from webapp.jobs import JobManager
 from fte.fte import main
+import metrics  # application.py puts fte/ on sys.path
 
+# Selenium is slow to import, so it's left alone unless browsers are wanted
+if int(environ.get("WEBDRIVER_POOL_WARM", 0)):
+    from webdriver import warm_webdrivers
 
-def _cleanup_tmp_dirs():
-    root = Path(environ["WORKING_DIR"])
-    for tmp_dir in root.iterdir():
-        conditions = [tmp_dir.is_dir()]
-        conditions.append(".tmpdir" in tmp_dir.name)
-        conditions.append((tmp_dir / "tmp_ready").is_file())
-        conditions.append(not (tmp_dir / "tmp_destroying").is_file())
-        if all(conditions):
-            tmp_dir.touch("tmp_destroying")
-            for tmp_file in tmp_dir.iterdir():
-                if tmp_file.is_file():
-                    tmp_file.unlink(missing_ok=True)
-            tmp_dir.rmdir()
+    warm_webdrivers()
+
+
+def _build(url: str, option: str, progress, path: str) -> str:
+    """Build a job's ebook. Downloads are written to path, not UPLOAD_DIR"""
+    if option != "download":
+        dst_dir = environ["UPLOAD_DIR"]
+        return main(url, verbosity=True, dst_dir=dst_dir, progress=progress)
+
+    with open(path, "wb") as ebook_file:
+        return main(
+            url, verbosity=True, dst_file=ebook_file, progress=progress
+        )
+
+
+jobs = JobManager(
+    _build,
+    workers=int(environ.get("JOB_WORKERS", 2)),
+    max_queued=int(environ.get("MAX_QUEUED_JOBS", 50)),
+    ttl=float(environ.get("JOB_TTL", 3600)),
+    job_dir=environ.get("JOB_DIR"),
+)
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -29,33 +49,53 @@ def index():
     form = StoryURLForm()
 
     if form.validate_on_submit():
-        _cleanup_tmp_dirs()
-
-        tmp = f".tmpdir_{sha256(str(dt.now()).encode('utf-8')).hexdigest()}"
-        tmp_dir = Path(f'{environ["WORKING_DIR"]}/{tmp}')
-        tmp_dir.mkdir()
-
         try:
-            if form.options.data == "download":
-                main(form.url.data, verbosity=True, dst_dir=tmp_dir.resolve())
-                for item in tmp_dir.iterdir():
-                    if item.is_file() and "tmp" not in item.name:
-                        return send_file(item.resolve(), as_attachment=True)
-
-            elif form.options.data == "upload":
-                main(
-                    form.url.data,
-                    verbosity=True,
-                    dst_dir=environ["UPLOAD_DIR"],
-                )
-
+            job = jobs.submit(form.url.data, form.options.data)
         except Exception as e:
             flash(str(e))
+            return redirect(url_for("index"))
 
-        finally:
-            (tmp_dir / "tmp_ready").touch()
-
-        return redirect(url_for("index"))
+        return redirect(url_for("job_page", job_id=job.id))
 
     form.options.data = "download"
     return render_template("index.html", title="Fanfiction-to-Ebook", form=form)  # noqa
+
+
+def _get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return job
+
+
+@app.route("/jobs/<job_id>")
+def job_page(job_id: str):
+    job = _get_job(job_id)
+    return render_template("job.html", title="Fanfiction-to-Ebook", job=job)
+
+
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id: str):
+    return jsonify(_get_job(job_id).to_dict())
+
+
+@app.route("/jobs/<job_id>/download")
+def job_download(job_id: str):
+    job = _get_job(job_id)
+    if job.status != "finished" or job.option != "download":
+        abort(404)
+    return send_file(
+        job.path,
+        mimetype="application/epub+zip",
+        as_attachment=True,
+        download_name=job.ebook,
+    )
+
+
+@app.route("/metrics")
+def metrics_page():
+    """Request, cache, rate limit, and build stage metrics, for Prometheus"""
+    return Response(
+        metrics.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )